@@ -2,14 +2,17 @@ import sys
 from pathlib import Path
 import subprocess as sp
 import random
+import itertools
 
 import numpy as np
 
 from tqdm import tqdm
 import torch
 
-from .utils.audio import AudioDataset, AudioDataLoader, Int2OneHot
-from .utils.kaldi_io import smart_open, read_string, read_vec_int
+from .utils.audio import AudioDataset, AudioDataLoader, Int2OneHot, match_length
+from .utils.shard import pack_shards
+from .utils.prep_state import PrepState, StageState, hash_bytes, hash_file
+from .utils.kaldi_io import ArkBuffer
 from .utils.logger import logger
 from .utils import params as p
 
@@ -22,6 +25,7 @@ of its own scripts, especially the data/ and the exp/
 KALDI_ROOT = Path("/home/jbaik/kaldi").resolve()
 ASPIRE_ROOT = Path(KALDI_ROOT, "egs/aspire/ics").resolve()
 DATA_ROOT = (Path(__file__).parent / "data" / "aspire").resolve()
+GRAPH_ROOT = (Path(__file__).parent / "kaldi" / "graph").resolve()
 
 assert KALDI_ROOT.exists(), \
     f"no such path \"{str(KALDI_ROOT)}\" not found"
@@ -33,146 +37,416 @@ WIN_SAMP_SHIFT = p.SAMPLE_RATE * p.WINDOW_SHIFT
 SAMPLE_MARGIN = WIN_SAMP_SHIFT * p.FRAME_MARGIN  # samples
 
 
-def get_num_lines(filename):
-    import mmap
-
-    with open(filename, "r+") as f:
-        buf = mmap.mmap(f.fileno(), 0)
-        lines = 0
-        while buf.readline():
-            lines += 1
+def get_num_lines(filename, chunk_size=1 << 22):
+    lines = 0
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            lines += chunk.count(b"\n")
     return lines
 
 
+def iter_lines(filename, chunk_size=1 << 22):
+    """
+    reads a (optionally .gz or .bz2 compressed) text file exactly once in large chunks
+    and yields its lines, while the progress is reported by the bytes read from the disk
+    """
+    import gzip
+    import bz2
+
+    filename = Path(filename)
+    if not filename.exists():
+        for ext in [".gz", ".bz2"]:
+            if Path(str(filename) + ext).exists():
+                filename = Path(str(filename) + ext)
+                break
+    readers = {".gz": lambda x: gzip.GzipFile(fileobj=x), ".bz2": bz2.BZ2File}
+    with open(filename, "rb") as raw, \
+         tqdm(total=filename.stat().st_size, unit="B", unit_scale=True) as pbar:
+        f = readers.get(filename.suffix, lambda x: x)(raw)
+        rest, pos = b"", 0
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            lines = (rest + chunk).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line.decode("utf-8")
+            pbar.update(raw.tell() - pos)
+            pos = raw.tell()
+        if rest:
+            yield rest.decode("utf-8")
+
+
 def strip_text(text):
     mask = "abcdefghijklmnopqrstuvwxyz'- "
     stripped = [x for x in text.lower() if x in mask]
     return ''.join(stripped)
 
 
-def split_wav(mode, target_dir):
+def read_segments(data_dir):
+    segments_file = Path(data_dir, "segments")
+    logger.info(f"processing {str(segments_file)} file ...")
+    segments = dict()
+    for line in iter_lines(segments_file):
+        split = line.split()
+        if not split:
+            continue
+        uttid, wavid, start, end = split[0], split[1], float(split[2]), float(split[3])
+        segments.setdefault(wavid, list()).append((uttid, start, end))
+    return segments
+
+
+def iter_split_wav(mode, target_dir, skip=None):
+    """
+    yields (wavid, uttid, wav_file, samples) of each segment while splitting the wav files
+    listed in wav.scp, reading the segments and wav.scp files only once.
+    skip(wavid, line, segments) can tell the wav files not to be processed
+    """
     import io
     import wave
 
     data_dir = Path(ASPIRE_ROOT, "data", mode).resolve()
-    segments_file = Path(data_dir, "segments")
-    logger.info(f"processing {str(segments_file)} file ...")
-    segments = dict()
-    with smart_open(segments_file, "r") as f:
-        for line in tqdm(f, total=get_num_lines(segments_file)):
-            split = line.strip().split()
-            uttid, wavid, start, end = split[0], split[1], float(split[2]), float(split[3])
-            if wavid in segments:
-                segments[wavid].append((uttid, start, end))
-            else:
-                segments[wavid] = [(uttid, start, end)]
+    segments = read_segments(data_dir)
 
     wav_scp = Path(data_dir, "wav.scp")
     logger.info(f"processing {str(wav_scp)} file ...")
-    manifest = dict()
-    with smart_open(wav_scp, "r") as f:
-        for line in tqdm(f, total=get_num_lines(wav_scp)):
-            wavid, cmd = line.strip().split(" ", 1)
-            if not wavid in segments:
-                continue
-            cmd = cmd.strip().rstrip(' |').split()
-            p = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-            fp = io.BytesIO(p.stdout)
-            with wave.openfp(fp, "rb") as wav:
-                fr = wav.getframerate()
-                nf = wav.getnframes()
-                for uttid, start, end in segments[wavid]:
-                    fs, fe = int(fr * start - SAMPLE_MARGIN), int(fr * end + SAMPLE_MARGIN)
-                    if fs < 0 or fe > nf:
-                        continue
-                    wav.rewind()
-                    wav.setpos(fs)
-                    signal = wav.readframes(fe - fs)
-                    tar_dir = Path(target_dir) / uttid[6:9]
-                    Path(tar_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
-                    wav_file = str(Path(tar_dir, uttid + ".wav"))
-                    with wave.open(wav_file, "wb") as split_wav:
-                        split_wav.setparams(wav.getparams())
-                        split_wav.writeframes(signal)
-                    manifest[uttid] = (wav_file, fe - fs)
-    return manifest
+    for line in iter_lines(wav_scp):
+        if not line.strip():
+            continue
+        wavid, cmd = line.strip().split(" ", 1)
+        if not wavid in segments:
+            continue
+        if skip is not None and skip(wavid, line, segments[wavid]):
+            continue
+        cmd = cmd.strip().rstrip(' |').split()
+        p = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        fp = io.BytesIO(p.stdout)
+        with wave.openfp(fp, "rb") as wav:
+            fr = wav.getframerate()
+            nf = wav.getnframes()
+            for uttid, start, end in segments[wavid]:
+                fs, fe = int(fr * start - SAMPLE_MARGIN), int(fr * end + SAMPLE_MARGIN)
+                if fs < 0 or fe > nf:
+                    continue
+                wav.rewind()
+                wav.setpos(fs)
+                signal = wav.readframes(fe - fs)
+                tar_dir = Path(target_dir) / uttid[6:9]
+                Path(tar_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
+                wav_file = str(Path(tar_dir, uttid + ".wav"))
+                with wave.open(wav_file, "wb") as split_wav:
+                    split_wav.setparams(wav.getparams())
+                    split_wav.writeframes(signal)
+                yield wavid, uttid, wav_file, fe - fs
 
 
-def get_transcripts(mode, target_dir):
+def split_wav(mode, target_dir):
+    return {uttid: (wav_file, samples) for _, uttid, wav_file, samples in iter_split_wav(mode, target_dir)}
+
+
+def iter_transcripts(mode, target_dir, skip=None):
+    """
+    yields (uttid, txt_file, text) while writing the normalized transcripts,
+    reading the text file only once. skip(uttid, line) can tell the lines not to be processed
+    """
     data_dir = Path(ASPIRE_ROOT, "data", mode).resolve()
     texts_file = Path(data_dir, "text")
     logger.info(f"processing {str(texts_file)} file ...")
-    manifest = dict()
-    with smart_open(Path(data_dir, "text"), "r") as f:
-        for line in tqdm(f, total=get_num_lines(texts_file)):
-            uttid, text = line.strip().split(" ", 1)
-            text = strip_text(text)
-            tar_dir = Path(target_dir) / uttid[6:9]
-            Path(tar_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
-            txt_file = str(Path(tar_dir, uttid + ".txt"))
-            with open(txt_file, "w") as txt:
-                txt.write(text + "\n")
-            manifest[uttid] = (txt_file, text)
-    return manifest
+    for line in iter_lines(texts_file):
+        if not line.strip():
+            continue
+        uttid, *text = line.strip().split(" ", 1)
+        if skip is not None and skip(uttid, line):
+            continue
+        text = strip_text(text[0] if text else "")
+        tar_dir = Path(target_dir) / uttid[6:9]
+        Path(tar_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
+        txt_file = str(Path(tar_dir, uttid + ".txt"))
+        with open(txt_file, "w") as txt:
+            txt.write(text + "\n")
+        yield uttid, txt_file, text
 
 
-def get_alignments(target_dir):
-    import io
-    import pipes
-    import gzip
+def get_transcripts(mode, target_dir):
+    return {uttid: (txt_file, text) for uttid, txt_file, text in iter_transcripts(mode, target_dir)}
+
 
+def _get_ali_model():
     exp_dir = Path(ASPIRE_ROOT, "exp", "tri5a").resolve()
     models = exp_dir.glob("*.mdl")
     model = sorted(models, key=lambda x: x.stat().st_mtime)[-1]
+    alis = sorted(exp_dir.glob("ali.*.gz"))
+    return model, alis
+
+
+def iter_alignments(target_dir, skip=None):
+    """
+    yields (ali_file, uttid, phn_file, num_frms, phones) while converting the alignments
+    into per-frame phones. skip(ali_file) can tell the ali files not to be processed
+    """
+    import io
+    import gzip
 
+    model, alis = _get_ali_model()
     logger.info("processing alignment files ...")
-    manifest = dict()
-    alis = [x for x in exp_dir.glob("ali.*.gz")]
     for ali in tqdm(alis):
+        if skip is not None and skip(ali):
+            continue
         cmd = [ str(Path(KALDI_ROOT, "src", "bin", "ali-to-phones")),
                 "--per-frame", f"{model}", f"ark:-", f"ark,f:-" ]
         with gzip.GzipFile(ali, "rb") as a:
             p = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, input=a.read())
             with io.BytesIO(p.stdout) as f:
+                ark = ArkBuffer(f)
                 while True:
                     try:
-                        uttid = read_string(f)
+                        uttid = ark.read_string()
                     except ValueError:
                         break
-                    phones = read_vec_int(f)
+                    phones = ark.read_vec_int()
                     num_frms = len(phones)
                     tar_dir = Path(target_dir) / uttid[6:9]
                     Path(tar_dir).mkdir(mode=0o755, parents=True, exist_ok=True)
                     phn_file = str(Path(tar_dir, uttid + ".phn"))
                     np.savetxt(phn_file, phones, "%d")
-                    manifest[uttid] = (phn_file, num_frms, phones)
-    return manifest
+                    yield ali, uttid, phn_file, num_frms, phones
 
 
-def prepare_data(target_dir):
+def get_alignments(target_dir):
+    return {uttid: (phn_file, num_frms, phones)
+            for _, uttid, phn_file, num_frms, phones in iter_alignments(target_dir)}
+
+
+def _read_symbols(filename):
+    with open(filename, "r") as f:
+        return dict(line.split() for line in f if line.strip())
+
+
+def load_ctc_lexicon(graph_dir=GRAPH_ROOT):
     """
-    since the target time-alignment exists only on the train set,
-    we split the train set into train and dev set
+    loads words.txt, phones.txt, tokens.txt and align_lexicon.int made by mkgraph.sh,
+    and returns the word-to-id map and the lexicon mapping word ids to CTC token id sequences
     """
-    #train_wav_manifest = split_wav("train", DATA_ROOT)
-    train_txt_manifest = get_transcripts("train", DATA_ROOT)
-    #phn_manifest = get_alignments(DATA_ROOT)
+    words = {w: int(i) for w, i in _read_symbols(Path(graph_dir, "words.txt")).items()}
+    phones = {int(i): ph for ph, i in _read_symbols(Path(graph_dir, "phones.txt")).items()}
+    tokens = {t: int(i) for t, i in _read_symbols(Path(graph_dir, "tokens.txt")).items()}
+    lexicon = dict()
+    with open(Path(graph_dir, "align_lexicon.int"), "r") as f:
+        for line in f:
+            ids = [int(x) for x in line.split()]
+            # the first pronunciation is used for the words having multiple ones
+            if ids and ids[0] not in lexicon:
+                lexicon[ids[0]] = np.array([tokens[phones[x]] for x in ids[2:]], dtype=np.int32)
+    return words, lexicon
+
+
+_ctc_lexicon = None
+
+
+def _init_ctc_worker(graph_dir):
+    global _ctc_lexicon
+    _ctc_lexicon = load_ctc_lexicon(graph_dir)
+
+
+def _text2tokens(lines):
+    words, lexicon = _ctc_lexicon
+    unk = words.get("<unk>")
+    res, num_oov = list(), 0
+    for line in lines:
+        uttid, *text = line.strip().split(" ", 1)
+        seq = list()
+        for w in strip_text(text[0] if text else "").split():
+            wid = words.get(w, unk)
+            if wid not in lexicon:
+                num_oov += 1
+                continue
+            seq.append(lexicon[wid])
+        res.append((uttid, np.concatenate(seq) if seq else np.zeros(0, dtype=np.int32)))
+    return res, num_oov
 
-    logger.info("generating manifest files ...")
+
+def get_ctc_targets(mode, target_dir, graph_dir=GRAPH_ROOT, num_workers=8, chunk_size=10000):
+    """
+    converts the transcripts into CTC token id sequences via the lexicon in parallel,
+    and stores them packed into <mode>.ctc.npy with the offsets <mode>.ctc_offsets.npy
+    and the uttids <mode>.ctc_uttids.txt, to be memory-mapped by CtcTargets
+    """
+    from multiprocessing import Pool
+
+    data_dir = Path(ASPIRE_ROOT, "data", mode).resolve()
+    texts_file = Path(data_dir, "text")
+    logger.info(f"converting {str(texts_file)} into CTC targets ...")
+    lines = [x for x in iter_lines(texts_file) if x.strip()]
+    chunks = [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+
+    uttids, seqs, num_oov = list(), list(), 0
+    with Pool(num_workers, initializer=_init_ctc_worker, initargs=(graph_dir,)) as pool:
+        for res, oov in tqdm(pool.imap(_text2tokens, chunks), total=len(chunks)):
+            for uttid, seq in res:
+                uttids.append(uttid)
+                seqs.append(seq)
+            num_oov += oov
+
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in seqs], out=offsets[1:])
+    values = np.concatenate(seqs) if seqs else np.zeros(0, dtype=np.int32)
+    np.save(Path(target_dir, f"{mode}.ctc.npy"), values)
+    np.save(Path(target_dir, f"{mode}.ctc_offsets.npy"), offsets)
+    with open(Path(target_dir, f"{mode}.ctc_uttids.txt"), "w") as f:
+        f.writelines(f"{uttid}\n" for uttid in uttids)
+    logger.info(f"{len(uttids)} CTC targets, {len(values)} tokens are stored ({num_oov} oov words dropped)")
+
+
+class CtcTargets(object):
+    """CTC token id sequences made by get_ctc_targets, memory-mapped and looked up by uttid
+
+    Args:
+        target_dir (path): dir containing the packed CTC targets
+        mode (str): mode of the data the targets were made from
+    """
+
+    def __init__(self, target_dir, mode):
+        self.values = np.load(Path(target_dir, f"{mode}.ctc.npy"), mmap_mode="r")
+        self.offsets = np.load(Path(target_dir, f"{mode}.ctc_offsets.npy"))
+        with open(Path(target_dir, f"{mode}.ctc_uttids.txt"), "r") as f:
+            self.index = {uttid.strip(): i for i, uttid in enumerate(f)}
+
+    def __contains__(self, uttid):
+        return uttid in self.index
+
+    def __getitem__(self, uttid):
+        i = self.index[uttid]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.index)
+
+
+def _prep_wav(state, target_dir):
+    stage = StageState(state)
+
+    def skip(wavid, line, segments):
+        digest = hash_bytes(line, *(f"{u} {s} {e}" for u, s, e in segments))
+        if not stage.changed(wavid, digest):
+            return True
+        stage.begin(wavid, digest)
+        return False
+
+    for wavid, uttid, wav_file, samples in iter_split_wav("train", target_dir, skip):
+        stage.add(wavid, uttid, file=wav_file, samples=samples, hash=hash_file(wav_file))
+    stage.prune()
+    return stage.state
+
+
+def _prep_txt(state, target_dir):
+    stage = StageState(state)
+
+    def skip(uttid, line):
+        digest = hash_bytes(line)
+        if not stage.changed(uttid, digest):
+            return True
+        stage.begin(uttid, digest)
+        return False
+
+    for uttid, txt_file, text in iter_transcripts("train", target_dir, skip):
+        stage.add(uttid, uttid, file=txt_file, hash=hash_bytes(text + "\n"))
+    stage.prune()
+    return stage.state
+
+
+def _prep_phn(state, target_dir):
+    stage = StageState(state)
+    model, _ = _get_ali_model()
+    model_digest = hash_file(model)
+
+    def skip(ali):
+        digest = hash_bytes(model_digest, hash_file(ali))
+        if not stage.changed(str(ali), digest):
+            return True
+        stage.begin(str(ali), digest)
+        return False
+
+    for ali, uttid, phn_file, num_frms, _ in iter_alignments(target_dir, skip):
+        stage.add(str(ali), uttid, file=phn_file, num_frms=int(num_frms), hash=hash_file(phn_file))
+    stage.prune()
+    return stage.state
+
+
+CTC_GRAPH_FILES = ["words.txt", "phones.txt", "tokens.txt", "align_lexicon.int"]
+
+
+def _prep_ctc(state, target_dir, num_workers=8):
+    stage = StageState(state)
+    graph_files = [Path(GRAPH_ROOT, x) for x in CTC_GRAPH_FILES]
+    if not all(x.exists() for x in graph_files):
+        logger.warning(f"no lexicon found in {GRAPH_ROOT}, skipping the CTC targets. "
+                       f"need to run asr/kaldi/build.py first")
+        return stage.state
+    texts_file = Path(ASPIRE_ROOT, "data", "train", "text")
+    digest = hash_bytes(hash_file(texts_file), *(hash_file(x) for x in graph_files))
+    if stage.changed("train", digest):
+        stage.begin("train", digest)
+        get_ctc_targets("train", target_dir, num_workers=num_workers)
+        ctc_file = str(Path(target_dir, "train.ctc.npy"))
+        stage.add("train", "train", file=ctc_file, hash=hash_file(ctc_file))
+    stage.prune()
+    return stage.state
+
+
+def _prep_manifest(states, target_dir, digest):
+    wavs, txts, phns = [StageState(states[k]).outputs for k in ["wav", "txt", "phn"]]
     with open(Path(target_dir, "train.csv"), "w") as f1:
         with open(Path(target_dir, "dev.csv"), "w") as f2:
-            for k, v in train_wav_manifest.items():
-                if not k in train_txt_manifest:
+            for k in sorted(wavs):
+                if not k in txts:
                     continue
-                if not k in phn_manifest:
+                if not k in phns:
                     continue
-                wav_file, samples = v
-                txt_file, _ = train_txt_manifest[k]
-                phn_file, num_frms, _ = phn_manifest[k]
+                wav_file, samples = wavs[k]["file"], wavs[k]["samples"]
+                txt_file = txts[k]["file"]
+                phn_file, num_frms = phns[k]["file"], phns[k]["num_frms"]
                 if 0 < int(k[6:11]) < 60:
                     f2.write(f"{k},{wav_file},{samples},{phn_file},{num_frms},{txt_file}\n")
                 else:
                     f1.write(f"{k},{wav_file},{samples},{phn_file},{num_frms},{txt_file}\n")
+    stage = StageState()
+    stage.begin("inputs", digest)
+    for mode in ["train", "dev"]:
+        manifest_file = str(Path(target_dir, f"{mode}.csv"))
+        stage.add("inputs", mode, file=manifest_file, hash=hash_file(manifest_file))
+    return stage.state
+
+
+def prepare_data(target_dir, num_workers=3):
+    """
+    since the target time-alignment exists only on the train set,
+    we split the train set into train and dev set
+
+    the independent stages of splitting wav files, writing transcripts and converting
+    alignments run concurrently, and each of them recomputes only the units whose input
+    content changed since the last run, according to the states stored in <target_dir>/.prep.
+    the CTC targets of the train set, shared by the train and dev manifests, are converted
+    afterwards on their own process pool
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    prep_state = PrepState(Path(target_dir, ".prep"))
+    stages = {"wav": _prep_wav, "txt": _prep_txt, "phn": _prep_phn}
+    states = {k: prep_state.load(k) for k in stages}
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {k: executor.submit(fn, states[k], target_dir) for k, fn in stages.items()}
+        for k, future in futures.items():
+            states[k] = future.result()
+            prep_state.save(k, states[k])
+            logger.info(f"stage {k}: {len(states[k]['outputs'])} outputs are prepared.")
+
+    prep_state.save("ctc", _prep_ctc(prep_state.load("ctc"), target_dir))
+
+    digest = hash_bytes(*(StageState(states[k]).digest() for k in stages))
+    if StageState(prep_state.load("manifest")).changed("inputs", digest):
+        logger.info("generating manifest files ...")
+        prep_state.save("manifest", _prep_manifest(states, target_dir, digest))
+    else:
+        logger.info("manifest files are up to date.")
     logger.info("data preparation finished.")
 
 
@@ -184,9 +458,9 @@ def reconstruct_manifest(target_dir):
         with open(Path(target_dir, "dev.csv"), "w") as f2:
             for wav_file in Path(target_dir).glob("**/*.wav"):
                 uttid = wav_file.stem
-                txt_file = str(wav_file).replace("wav", "txt")
-                phn_file = str(wav_file).replace("wav", "phn")
-                if not Path(txt_file).exists() or not Path(phn_file).exists():
+                txt_file = wav_file.with_suffix(".txt")
+                phn_file = wav_file.with_suffix(".phn")
+                if not txt_file.exists() or not phn_file.exists():
                     continue
                 with wave.openfp(str(wav_file), "rb") as wav:
                     samples = wav.getnframes()
@@ -198,11 +472,82 @@ def reconstruct_manifest(target_dir):
     logger.info("data preparation finished.")
 
 
+# Kaldi's data set each manifest is built from, i.e. the source of its CTC targets;
+# the manifests of prepare_data, and the subsets of them, are split from the train set,
+# which is the only one prepare_data makes the CTC targets of
+MANIFEST_SOURCES = {
+    "train": "train",
+    "train_sup": "train",
+    "dev": "train",
+}
+
+
 def _samples2frames(samples):
     num_samples = samples - 2 * SAMPLE_MARGIN
     return int((num_samples - WIN_SAMP_SIZE) // WIN_SAMP_SHIFT + 1)
 
 
+def make_shards(target_dir, mode, shard_size=1000):
+    """
+    packs the wav, phn and txt files listed in the manifest into shard files,
+    which can be loaded by utils.shard.ShardedAudioDataset with the index <mode>.csv
+    """
+    manifest_file = Path(target_dir, f"{mode}.csv")
+    with open(manifest_file, "r") as f:
+        manifest = [tuple(x.strip().split(',')) for x in f.readlines()]
+
+    def entries():
+        for uttid, wav_file, samples, phn_file, num_frms, txt_file in manifest:
+            if mode == "train_unsup":
+                yield uttid, wav_file, _samples2frames(int(samples)), None, txt_file
+            else:
+                yield uttid, wav_file, int(num_frms), phn_file, txt_file
+
+    return pack_shards(entries(), Path(target_dir, "shards"), mode,
+                       shard_size=shard_size, sample_rate=p.SAMPLE_RATE)
+
+
+STRATA = {
+    # uttid looks like fe_03_00047-A-025005-025135
+    "conversation": lambda uttid: uttid.split('-', 1)[0],
+    "speaker": lambda uttid: uttid.rsplit('-', 2)[0],
+}
+
+
+def select_subset(uttids, frames, max_entries=None, max_frames=None, stratify=None, seed=0):
+    """
+    deterministically chooses a subset of the entries for a given seed,
+    bounded by the number of entries and/or the total number of frames.
+    if stratify is given as either one of the keys of STRATA, the entries are picked
+    from each speaker or conversation in turn so that the subset covers as many of them
+    as possible. returns the indices of the chosen entries in the original order
+    """
+    rng = random.Random(seed)
+    if stratify is None:
+        groups = [list(range(len(uttids)))]
+    else:
+        key_fn = STRATA[stratify]
+        strata = dict()
+        for i, uttid in enumerate(uttids):
+            strata.setdefault(key_fn(uttid), list()).append(i)
+        groups = [strata[k] for k in sorted(strata)]
+        rng.shuffle(groups)
+    for g in groups:
+        rng.shuffle(g)
+
+    max_entries = len(uttids) if max_entries is None else max_entries
+    max_frames = float("inf") if max_frames is None else max_frames
+    chosen, total = list(), 0
+    for i in (x for rnd in itertools.zip_longest(*groups) for x in rnd if x is not None):
+        if len(chosen) >= max_entries or total >= max_frames:
+            break
+        if total + frames[i] > max_frames:
+            continue
+        chosen.append(i)
+        total += frames[i]
+    return sorted(chosen)
+
+
 class Aspire(AudioDataset):
     """Kaldi's ASpIRE recipe (LDC Fisher dataset)
        loading Kaldi's frame-aligned phones target and the corresponding audio files
@@ -210,22 +555,49 @@ class Aspire(AudioDataset):
     Args:
         mode (str): either one of "train", "dev", or "test"
         data_dir (path): dir containing the processed data and manifests
+        data_size (int): max number of entries to be loaded
+        data_hours (float): max total duration of the entries to be loaded, in hours
+        data_frames (int): max total number of frames of the entries to be loaded
+        stratify (str): either one of "speaker" or "conversation" to spread the subset over
+        seed (int): seed of the subset selection, the same seed gives the same subset
+        subset_file (path): file storing the uttids of the subset; loaded if it exists,
+                            otherwise the chosen subset is written to it
+        target_type (str): "phn" for the frame-aligned phones, or "ctc" for the token id
+                           sequences prepared by get_ctc_targets, to be loaded by CtcDataLoader
     """
     root = DATA_ROOT
     entries = list()
     entry_frames = list()
 
-    def __init__(self, root=None, mode=None, data_size=1e30, *args, **kwargs):
+    def __init__(self, root=None, mode=None, data_size=None, data_hours=None, data_frames=None,
+                 stratify=None, seed=0, subset_file=None, target_type="phn", *args, **kwargs):
         assert mode in ["train_sup", "train_unsup", "train", "dev", "test"], \
             "invalid mode options: either one of \"train_sup\", \"train_unsup\", \"train\", \"dev\", or \"test\""
+        assert stratify is None or stratify in STRATA, \
+            f"invalid stratify options: either one of {list(STRATA)}"
         self.mode = mode
         self.data_size = data_size
+        self.data_frames = data_frames
+        if data_hours is not None:
+            frames = int(data_hours * 3600 / p.WINDOW_SHIFT)
+            self.data_frames = frames if data_frames is None else min(data_frames, frames)
+        self.stratify = stratify
+        self.seed = seed
+        self.subset_file = None if subset_file is None else Path(subset_file).resolve()
+        assert target_type in ["phn", "ctc"], \
+            "invalid target_type options: either one of \"phn\" or \"ctc\""
+        self.target_type = target_type
         if root is not None:
             self.root = Path(root).resolve()
+        assert target_type == "phn" or mode in MANIFEST_SOURCES, \
+            f"no CTC targets are prepared for the mode {mode}: " \
+            f"target_type \"ctc\" needs one of the modes {list(MANIFEST_SOURCES)}"
+        self.ctc_targets = CtcTargets(self.root, MANIFEST_SOURCES[mode]) if target_type == "ctc" else None
         self._load_manifest()
+        target_transform = Int2OneHot(p.NUM_LABELS) if target_type == "phn" else None
         super().__init__(frame_margin=p.FRAME_MARGIN, unit_frames=p.HEIGHT,
                          window_shift=p.WINDOW_SHIFT, window_size=p.WINDOW_SIZE,
-                         target_transform=Int2OneHot(p.NUM_LABELS), *args, **kwargs)
+                         target_transform=target_transform, *args, **kwargs)
 
     def __getitem__(self, index):
         uttid, wav_file, samples, phn_file, num_phns, txt_file = self.entries[index]
@@ -234,17 +606,16 @@ class Aspire(AudioDataset):
             tensors = self.transform(wav_file)
         if self.mode == "train_unsup":
             return tensors, None
+        if self.target_type == "ctc":
+            targets = torch.from_numpy(np.array(self.ctc_targets[uttid]))
+            if self.target_transform is not None:
+                targets = self.target_transform(targets)
+            return tensors, targets
         # read phn file
         targets = np.loadtxt(phn_file, dtype="int").tolist()
         if self.target_transform is not None:
             targets = self.target_transform(targets)
-        # manipulating when the length of data and targets are mismatched
-        l0, l1 = len(tensors), len(targets)
-        if l0 > l1:
-            tensors = tensors[:l1]
-        elif l0 < l1:
-            tensors.extend([torch.zeros_like(tensors[0]) for i in range(l1 - l0)])
-        return tensors, targets
+        return match_length(tensors, targets)
 
     def __len__(self):
         return len(self.entries)
@@ -262,15 +633,51 @@ class Aspire(AudioDataset):
         self.entries = [tuple(x.strip().split(',')) for x in manifest]
         # drop short entries less than 1 sec
         self.entries = [e for e in self.entries if (_samples2frames(int(e[2])) > 100)]
-        # randomly choose a number of data_size
-        size = min(self.data_size, len(manifest))
-        self.entries = random.sample(self.entries, size)
+        if self.ctc_targets is not None:
+            self.entries = [e for e in self.entries if e[0] in self.ctc_targets]
         if self.mode == "train_unsup":
             self.entry_frames = [_samples2frames(int(e[2])) for e in self.entries]
         else:
             self.entry_frames = [int(e[4]) for e in self.entries]
+        # choose the subset
+        chosen = None
+        if self.subset_file is not None and self.subset_file.exists():
+            chosen = self._load_subset()
+        if chosen is None:
+            chosen = select_subset([e[0] for e in self.entries], self.entry_frames,
+                                   max_entries=self.data_size, max_frames=self.data_frames,
+                                   stratify=self.stratify, seed=self.seed)
+            if self.subset_file is not None:
+                self._save_subset(chosen)
+        self.entries = [self.entries[i] for i in chosen]
+        self.entry_frames = [self.entry_frames[i] for i in chosen]
         logger.info(f"{len(self.entries)} entries, {sum(self.entry_frames)} frames are loaded.")
 
+    def _subset_header(self):
+        return (f"# mode={self.mode} data_size={self.data_size} data_frames={self.data_frames} "
+                f"stratify={self.stratify} seed={self.seed}")
+
+    def _load_subset(self):
+        logger.info(f"loading dataset subset {self.subset_file} ...")
+        with open(self.subset_file, "r") as f:
+            lines = f.readlines()
+        # a subset chosen with other options is chosen again, but a list of uttids without the header is taken as is
+        header = [x.strip() for x in lines if x.startswith('#')]
+        if header and header[0] != self._subset_header():
+            logger.warning(f"the subset {self.subset_file} was chosen with \"{header[0][2:]}\", "
+                           f"not with \"{self._subset_header()[2:]}\", choosing it again")
+            return None
+        uttids = set(x.strip() for x in lines if not x.startswith('#'))
+        return [i for i, e in enumerate(self.entries) if e[0] in uttids]
+
+    def _save_subset(self, chosen):
+        logger.info(f"saving dataset subset {self.subset_file} ...")
+        self.subset_file.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with open(self.subset_file, "w") as f:
+            f.write(self._subset_header() + "\n")
+            for i in chosen:
+                f.write(f"{self.entries[i][0]}\n")
+
 
 if __name__ == "__main__":
     if False:
@@ -0,0 +1,132 @@
+#!python
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .utils.audio import Augment, Spectrogram, make_manifest
+from .utils.kaldi_io import write_ark_shards, build_scp_index
+from .utils.logger import logger, set_logfile
+from .utils import params as p
+
+
+"""
+Offline bulk feature extraction: computes the Spectrogram features of a whole corpus once,
+and writes them as sharded Kaldi ark/scp, which can be read by utils.kaldi_dataset.KaldiFeatureDataset
+instead of decoding and transforming the raw audio on every epoch
+
+    python -m asr.extract --manifest data/aspire/train.csv --target-dir data/aspire/feats --name train
+    python -m asr.extract --wav-dir /path/to/wavs --target-dir /path/to/feats --name test
+"""
+
+
+def spect_to_matrix(data, frame_margin=p.FRAME_MARGIN):
+    """
+    converts a Spectrogram output of channel x n_freq_bin x n_frame into a Kaldi feature
+    matrix of (n_frame - 2 * frame_margin) x (channel * n_freq_bin), one row per frame.
+    the margin frames are dropped as FrameSplitter does, so that the row i is aligned to
+    the frame i of the targets
+    """
+    c, w, h = data.shape
+    data = data.numpy()[:, :, frame_margin:max(h - frame_margin, frame_margin)]
+    return np.ascontiguousarray(data.transpose(2, 0, 1).reshape(-1, c * w), dtype=np.float32)
+
+
+def read_manifest(manifest_file):
+    # Aspire manifest lines look like uttid,wav_file,samples,phn_file,num_phns,txt_file
+    with open(manifest_file, "r") as f:
+        entries = [x.strip().split(',') for x in f if x.strip()]
+    return [(e[0], e[1]) for e in entries]
+
+
+def read_wav_dir(wav_dir):
+    return [(Path(x).stem, str(x)) for x in sorted(make_manifest(wav_dir))]
+
+
+class FeatureExtractor(object):
+    """Picklable job of write_ark_shards, returning the (uttid, feature matrix) of a wav file
+
+    Args:
+        see AudioDataset for the augmentation and the spectrogram options
+    """
+
+    def __init__(self, resample=False, sample_rate=p.SAMPLE_RATE,
+                 tempo=False, tempo_range=p.TEMPO_RANGE,
+                 gain=False, gain_range=p.GAIN_RANGE,
+                 noise=False, noise_range=p.NOISE_RANGE,
+                 window_shift=p.WINDOW_SHIFT, window_size=p.WINDOW_SIZE,
+                 window=p.WINDOW, nfft=p.NFFT, normalize=True, frame_margin=p.FRAME_MARGIN):
+        self.augment = Augment(resample=resample, sample_rate=sample_rate,
+                               tempo=tempo, tempo_range=tempo_range,
+                               gain=gain, gain_range=gain_range,
+                               noise=noise, noise_range=noise_range)
+        self.spectrogram = Spectrogram(sample_rate=sample_rate, window_shift=window_shift,
+                                       window_size=window_size, window=window, nfft=nfft,
+                                       normalize=normalize)
+        self.frame_margin = frame_margin
+
+    def __call__(self, job):
+        uttid, wav_file = job
+        try:
+            data = self.spectrogram(self.augment(wav_file))
+        except Exception as e:
+            logger.warning(f"skipping {uttid}: failed to extract the features of {wav_file}: {e}")
+            return None
+        return uttid, spect_to_matrix(data, self.frame_margin)
+
+
+def extract_features(jobs, target_dir, name, num_shards=16, num_workers=8, compress=None, **kwargs):
+    """
+    extracts the features of the (uttid, wav_file) jobs on a pool of num_workers processes into
+    <target_dir>/<name>.<shard_id>.ark/scp and the merged <target_dir>/<name>.scp, and reports
+    the throughput. the other kwargs are passed to FeatureExtractor
+    """
+    extractor = FeatureExtractor(**kwargs)
+    logger.info(f"extracting the features of {len(jobs)} utterances into {num_shards} shards "
+                f"with {num_workers} workers ...")
+    start = time.time()
+    scp_file, count = write_ark_shards(extractor, jobs, target_dir, name, num_shards=num_shards,
+                                       num_workers=num_workers, compress=compress)
+    elapsed = time.time() - start
+
+    # the shape index is built here once, so the consumers of the scp start without scanning the arks
+    frames = sum(x[3] for x in build_scp_index(scp_file, num_workers))
+    hours = frames * kwargs.get("window_shift", p.WINDOW_SHIFT) / 3600
+    logger.info(f"{count} of {len(jobs)} utterances, {frames} frames ({hours:.2f} hours) "
+                f"are written to {scp_file} in {elapsed:.1f} secs")
+    logger.info(f"throughput: {count / elapsed:.1f} utts/sec, {frames / elapsed:.0f} frames/sec, "
+                f"{hours * 3600 / elapsed:.1f}x real time with {num_workers} workers")
+    return scp_file
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="offline bulk feature extraction into Kaldi ark/scp")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--manifest', type=str, help="Aspire manifest csv file of the utterances")
+    group.add_argument('--wav-dir', type=str, help="dir containing the audio files, the file stems are used as uttids")
+    parser.add_argument('--target-dir', type=str, required=True, help="dir to write the ark and scp files")
+    parser.add_argument('--name', default='feats', type=str, help="name of the scp and the prefix of the shards")
+    parser.add_argument('--num-shards', default=16, type=int, help="number of the ark/scp shards")
+    parser.add_argument('--num-workers', default=8, type=int, help="number of the worker processes")
+    parser.add_argument('--compress', default=None, choices=["CM", "CM2", "CM3"], help="compressed matrix format")
+    parser.add_argument('--resample', default=False, action='store_true', help="resample to the sample rate")
+    parser.add_argument('--sample-rate', default=p.SAMPLE_RATE, type=int, help="sample rate of the audio")
+    parser.add_argument('--tempo', default=False, action='store_true', help="random tempo augmentation")
+    parser.add_argument('--gain', default=False, action='store_true', help="random gain augmentation")
+    parser.add_argument('--noise', default=False, action='store_true', help="random noise augmentation")
+    parser.add_argument('--no-normalize', default=False, action='store_true', help="skip the per-utterance normalization")
+    parser.add_argument('--log-dir', default='./logs', type=str, help="filename for logging the outputs")
+    args = parser.parse_args()
+
+    set_logfile(Path(args.log_dir, "extract.log"))
+    logger.info(f"Feature extraction started with command: {' '.join(sys.argv)}")
+
+    jobs = read_manifest(args.manifest) if args.manifest is not None else read_wav_dir(args.wav_dir)
+    extract_features(jobs, args.target_dir, args.name,
+                     num_shards=args.num_shards, num_workers=args.num_workers, compress=args.compress,
+                     resample=args.resample, sample_rate=args.sample_rate,
+                     tempo=args.tempo, gain=args.gain, noise=args.noise,
+                     normalize=not args.no_normalize)
@@ -32,9 +32,10 @@ extra_compile_args = [
     "-std=c++11",
     "-w",
     "-fPIC",
+    "-pthread",
 ]
 library_dirs = list()
-extra_link_args = list()
+extra_link_args = ["-pthread"]
 
 kaldi_lib_root = KALDI_ROOT + "/src"
 for lib in Path(kaldi_lib_root).rglob("libkaldi-*.so"):
@@ -6,6 +6,7 @@ from torch.autograd import Function
 
 from .._path import KALDI_ROOT
 from .._ext import latgen_lib
+from ...utils.ctc_decoder import DecoderOutput, SymbolTable, skip_blank_frames, expand_alignments
 
 
 GRAPH_PATH = Path(__file__).parents[1].joinpath("graph")
@@ -14,15 +15,32 @@ if not GRAPH_PATH.exists():
     sys.exit(1)
 
 DEFAULT_TOKEN = GRAPH_PATH.joinpath("tokens.txt")
-DEFAULT_GRAPH = GRAPH_PATH.joinpath("TLG.fst")
+# the memory-mapped ConstFst graph is shared by all the decoding processes
+DEFAULT_GRAPH = GRAPH_PATH.joinpath("TLG.const.fst")
+if not DEFAULT_GRAPH.exists():
+    DEFAULT_GRAPH = GRAPH_PATH.joinpath("TLG.fst")
 DEFAULT_WORDS = GRAPH_PATH.joinpath("words.txt")
+# the first-pass LM composed into the graph, whose scores are replaced in the lattice rescoring
+DEFAULT_LM = GRAPH_PATH.joinpath("G.fst")
 
 
 class LatGenDecoder(Function):
+    """
+    each instance owns its own decoder handle in the extension, i.e. its own graph,
+    word symbol table and options, so several graphs can be served in a process at once
+
+    the utterances of a batch are decoded in parallel on num_threads native threads, each with
+    its own decoder on the shared graph; the GIL is released by cffi during the decode call
+
+    with blank_skip, the runs of the frames whose blank posterior exceeds blank_skip are merged into
+    their first frames before the search, so the decoding time drops with the ratio of the blank frames
+    of a CTC model; the alignments are mapped back to the original frames, but the costs are those of
+    the compacted frames
+    """
 
     def __init__(self, beam=16.0, max_active=8000, min_active=200,
-                 acoustic_scale=1.0, allow_partial=True,
-                 token_file=str(DEFAULT_TOKEN),
+                 acoustic_scale=1.0, allow_partial=True, num_threads=1,
+                 blank_skip=None, blank="<blk>", token_file=str(DEFAULT_TOKEN),
                  fst_file=str(DEFAULT_GRAPH), wd_file=str(DEFAULT_WORDS)):
         # store number of tokens
         lines = list()
@@ -30,21 +48,223 @@ class LatGenDecoder(Function):
             for line in f:
                 lines.append(line.strip().split())
         self.num_token = len(lines)
+        self.num_threads = num_threads
+        self.blank_skip = blank_skip
+        if blank_skip is not None:
+            # the column of a token is its id - 1
+            self.blank = [int(x[1]) for x in lines if x[0] == blank][0] - 1
+        self.words = SymbolTable(wd_file)
         # initialize
         fst_in_filename = fst_file.encode('ascii')
         wd_in_filename = wd_file.encode('ascii')
-        latgen_lib.initialize(beam, max_active, min_active, acoustic_scale,
-                              allow_partial, fst_in_filename, wd_in_filename)
+        self.handle = latgen_lib.create_decoder(beam, max_active, min_active, acoustic_scale,
+                                                allow_partial, fst_in_filename, wd_in_filename)
+        if self.handle == 0:
+            raise IOError(f"could not load the decoding graph {fst_file} or the words {wd_file}")
+
+    def __del__(self):
+        if getattr(self, "handle", 0):
+            latgen_lib.destroy_decoder(self.handle)
+            self.handle = 0
 
-    def forward(self, loglikes):
+    def forward(self, loglikes, lengths=None):
+        """
+        loglikes is a N x R x C tensor of N utterances padded to R frames, and lengths is a tensor
+        of the N numbers of the valid frames; the padded frames beyond the lengths are not decoded.
+        the decoder reads loglikes in place with its strides, so a non-contiguous view
+        (e.g. a transpose or a slice of the model output) is decoded without a copy
+
+        returns a DecoderOutput of the ragged word ids and alignments (flat values + N + 1 offsets),
+        and the cost, the partial flag and the fail flag of every utterance
+        """
         assert loglikes.dim() == 3 and loglikes.shape[-1] == self.num_token
+        assert lengths is None or lengths.numel() == loglikes.shape[0]
+        if self.blank_skip is not None:
+            loglikes, skipped_lengths, index, lengths = self._skip_blank_frames(loglikes, lengths)
+            return expand_alignments(self._decode(loglikes, skipped_lengths), index, lengths)
+        return self._decode(loglikes, lengths)
+
+    def _decode(self, loglikes, lengths=None):
         with torch.no_grad():
             # N: batch size, RxC: R frames for C classes
-            words = torch.IntTensor().zero_()
-            alignments = torch.IntTensor().zero_()
+            lengths = torch.IntTensor() if lengths is None else lengths.int().cpu().contiguous()
+            out = DecoderOutput(words=torch.IntTensor(), word_offsets=torch.IntTensor(),
+                                alignments=torch.IntTensor(), alignment_offsets=torch.IntTensor(),
+                                costs=torch.FloatTensor(), partial=torch.IntTensor(), failed=torch.IntTensor())
             # actual decoding
-            latgen_lib.decode(loglikes, words, alignments)
-        return words, alignments
+            if not latgen_lib.decode(self.handle, loglikes, lengths, *out, self.num_threads):
+                raise RuntimeError(f"decoding failed: invalid decoder handle {self.handle} "
+                                   f"or {lengths.numel()} lengths for a batch of {loglikes.shape[0]}")
+        return out
+
+    def texts(self, output):
+        """
+        converts the word ids of a DecoderOutput into the strings of the words
+        """
+        return output.texts(self.words)
+
+    def _skip_blank_frames(self, loglikes, lengths):
+        if lengths is None:
+            lengths = torch.full((loglikes.shape[0],), loglikes.shape[1], dtype=torch.long)
+        loglikes, skipped_lengths, index = skip_blank_frames(loglikes, lengths, self.blank_skip, self.blank)
+        return loglikes, skipped_lengths, index, lengths
+
+    def decode_lattices(self, loglikes, lengths=None, lattice_beam=8.0):
+        """
+        decodes with the LatticeFasterDecoder into word lattices pruned by lattice_beam,
+        which can be rescored with a LatticeRescorer before taking their best paths
+        """
+        assert loglikes.dim() == 3 and loglikes.shape[-1] == self.num_token
+        assert lengths is None or lengths.numel() == loglikes.shape[0]
+        frames = None
+        if self.blank_skip is not None:
+            loglikes, lengths, index, orig_lengths = self._skip_blank_frames(loglikes, lengths)
+            frames = (index, orig_lengths)
+        with torch.no_grad():
+            lengths = torch.IntTensor() if lengths is None else lengths.int().cpu().contiguous()
+            ids = torch.IntTensor()
+            if not latgen_lib.decode_lattices(self.handle, loglikes, lengths, ids, lattice_beam,
+                                              self.num_threads):
+                raise RuntimeError(f"lattice decoding failed: invalid decoder handle {self.handle} "
+                                   f"or {lengths.numel()} lengths for a batch of {loglikes.shape[0]}")
+        return Lattices(ids, frames)
 
     def backward(self, grad_output):
         pass
+
+    def session(self):
+        """
+        starts an online decoding session of an utterance on the graph of this decoder
+        """
+        return LatGenSession(self)
+
+
+class LatGenSession(object):
+    """
+    online decoding session of an utterance, advanced with the chunks of its log-likelihoods
+    as they arrive, so that the partial hypotheses are available with the latency of a chunk.
+    a session should not be used by several threads at once
+
+        session = decoder.session()
+        for chunk in chunks:           # R x C tensors
+            session.advance(chunk)
+            words, alignments, failed = session.partial()
+        words, alignments, failed = session.finalize()
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder  # keeps the decoder handle alive
+        self.num_token = decoder.num_token
+        self.handle = latgen_lib.create_session(decoder.handle)
+        if self.handle == 0:
+            raise RuntimeError("could not create a decoding session")
+        self.num_frames = 0
+
+    def __del__(self):
+        if getattr(self, "handle", 0):
+            latgen_lib.destroy_session(self.handle)
+            self.handle = 0
+
+    def _check_handle(self):
+        if self.handle == 0:
+            raise RuntimeError("the decoding session is already finalized")
+
+    def advance(self, loglikes):
+        """
+        decodes a chunk of R x C log-likelihoods, returns the number of frames decoded so far
+        """
+        assert loglikes.dim() == 2 and loglikes.shape[-1] == self.num_token
+        self._check_handle()
+        with torch.no_grad():
+            num_frames = latgen_lib.advance_session(self.handle, loglikes.float().cpu())
+        if num_frames < 0:
+            raise RuntimeError(f"invalid decoding session handle {self.handle}")
+        self.num_frames = num_frames
+        return self.num_frames
+
+    def partial(self):
+        """
+        returns the words and the alignments of the best partial path decoded so far,
+        and whether it failed, e.g. before any frame is decoded
+        """
+        self._check_handle()
+        words, alignments = torch.IntTensor(), torch.IntTensor()
+        failed = not latgen_lib.get_partial(self.handle, words, alignments)
+        return words, alignments, failed
+
+    def finalize(self):
+        """
+        ends the utterance, returns the words and the alignments of the best path,
+        and whether it failed, in which case they are empty
+        """
+        self._check_handle()
+        words, alignments = torch.IntTensor(), torch.IntTensor()
+        try:
+            failed = not latgen_lib.finalize_session(self.handle, words, alignments)
+        finally:
+            latgen_lib.destroy_session(self.handle)
+            self.handle = 0
+        return words, alignments, failed
+
+
+class Lattices(object):
+    """
+    lattices of a batch of utterances, kept in the extension and referred by their ids (0 if failed).
+    frames is the (index, lengths) of skip_blank_frames if the lattices are of the compacted frames
+    """
+
+    def __init__(self, ids, frames=None):
+        self.ids = ids
+        self.frames = frames
+
+    def __len__(self):
+        return self.ids.numel()
+
+    def __del__(self):
+        if getattr(self, "ids", None) is not None:
+            latgen_lib.destroy_lattices(self.ids)
+            self.ids = None
+
+    def best_paths(self):
+        """
+        returns a DecoderOutput of the best paths of the lattices
+        """
+        out = DecoderOutput(words=torch.IntTensor(), word_offsets=torch.IntTensor(),
+                            alignments=torch.IntTensor(), alignment_offsets=torch.IntTensor(),
+                            costs=torch.FloatTensor(), partial=torch.IntTensor(), failed=torch.IntTensor())
+        if not latgen_lib.lattice_best_paths(self.ids, *out):
+            raise RuntimeError("could not get the best paths of the lattices")
+        return out if self.frames is None else expand_alignments(out, *self.frames)
+
+    def rescore(self, rescorer):
+        """
+        returns the new lattices rescored by the LatticeRescorer
+        """
+        ids = torch.IntTensor()
+        if not latgen_lib.rescore_lattices(rescorer.handle, self.ids, ids):
+            raise RuntimeError(f"lattice rescoring failed: invalid rescorer handle {rescorer.handle}")
+        return Lattices(ids, self.frames)
+
+
+class LatticeRescorer(object):
+    """
+    second-pass rescoring of the lattices with a larger LM: the scores of the first-pass LM old_lm_file
+    (G.fst of the graph) are subtracted, and the scores of new_lm_file are added. new_lm_file is either
+    a G.fst, or a const-ARPA LM built by Kaldi's arpa-to-const-arpa if const_arpa is True.
+    if old_lm_file is None, the scores of the new LM are only added
+
+        lattices = decoder.decode_lattices(loglikes, lengths)
+        output = lattices.rescore(rescorer).best_paths()
+    """
+
+    def __init__(self, new_lm_file, old_lm_file=str(DEFAULT_LM), const_arpa=False):
+        old_lm_filename = b"" if old_lm_file is None else str(old_lm_file).encode('ascii')
+        new_lm_filename = str(new_lm_file).encode('ascii')
+        self.handle = latgen_lib.create_rescorer(old_lm_filename, new_lm_filename, int(const_arpa))
+        if self.handle == 0:
+            raise IOError(f"could not load the LMs {old_lm_file} or {new_lm_file}")
+
+    def __del__(self):
+        if getattr(self, "handle", 0):
+            latgen_lib.destroy_rescorer(self.handle)
+            self.handle = 0
@@ -38,6 +38,7 @@ mkdir -p $out_dir
 cp $lang_dir/words.txt $out_dir
 cp $lang_dir/phones.txt $out_dir
 cp $lang_dir/phones/align_lexicon.int $out_dir
+cp $lang_dir/G.fst $out_dir  # the first-pass LM, to be replaced in the lattice rescoring
 
 # Get the full list of CTC tokens used in FST. These tokens include <eps>, the blank <blk>, the actual labels (e.g.,
 # phonemes), and the disambiguation symbols.  
@@ -107,5 +108,18 @@ else
   else
     echo "TLG.fst already exists and is new"
   fi
+
+  # Convert the graph into an aligned ConstFst, which the decoder memory-maps read-only
+  # so that all the decoding processes share a single copy of it
+  tlg_const_fst=$out_dir/TLG.const.fst
+  tlg_const_tmp=$tlg_const_fst.$$
+  trap "rm -f $tlg_const_tmp" EXIT HUP INT PIPE TERM
+  if [[ ! -s $tlg_const_fst || $tlg_const_fst -ot $tlg_fst ]]; then
+    fstconvert --fst_type=const --fst_align=true $tlg_fst $tlg_const_tmp || exit 1;
+    mv $tlg_const_tmp $tlg_const_fst
+    echo "Converting decoding graph TLG.const.fst succeeded"
+  else
+    echo "TLG.const.fst already exists and is new"
+  fi
 fi
 
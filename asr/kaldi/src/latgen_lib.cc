@@ -21,6 +21,15 @@
 // modified by Jinserk Baik <jinserk.baik@gmail.com>
 
 #include <sstream>
+#include <fstream>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <atomic>
+#include <thread>
+#include <algorithm>
+#include <limits>
+#include <functional>
 
 #include <TH/TH.h>
 #include <ATen/ATen.h>
@@ -29,9 +38,13 @@
 #include "util/common-utils.h"
 #include "fstext/fstext-lib.h"
 #include "decoder/faster-decoder.h"
+#include "decoder/lattice-faster-decoder.h"
 #include "decoder/decodable-matrix.h"
 #include "base/timer.h"
 #include "lat/kaldi-lattice.h" // for {Compact}LatticeArc
+#include "lat/lattice-functions.h"
+#include "lat/determinize-lattice-pruned.h"
+#include "lm/const-arpa-lm.h"
 
 using namespace kaldi;
 using namespace at;
@@ -48,7 +61,7 @@ struct LatticeDecoderOptions
 	BaseFloat acoustic_scale_;
 	bool allow_partial_;
 
-	VectorFst<StdArc> *decode_fst_ = NULL;
+	fst::Fst<StdArc> *decode_fst_ = NULL;
 	fst::SymbolTable *word_syms_ = NULL;
 
 	LatticeDecoderOptions()
@@ -72,10 +85,28 @@ struct LatticeDecoderOptions
 		decoder_opts_.hash_ratio = hash_ratio;
 	}
 
+	// a ConstFst graph, e.g. converted by fstconvert --fst_type=const --fst_align=true,
+	// is memory-mapped read-only, so that all the processes decoding with it share one copy
+	// in the page cache; any other graph is read into the heap as a VectorFst
+	static fst::Fst<StdArc> *read_graph(std::string fst_in_filename)
+	{
+		std::ifstream strm(fst_in_filename, std::ios_base::in | std::ios_base::binary);
+		fst::FstHeader hdr;
+		if (!strm || !hdr.Read(strm, fst_in_filename))
+			return NULL;
+		if (hdr.FstType() != "const")
+			return fst::ReadFstKaldi(fst_in_filename);
+
+		strm.seekg(0);
+		fst::FstReadOptions ropts(fst_in_filename);
+		ropts.mode = fst::FstReadOptions::MAP;
+		return fst::ConstFst<StdArc>::Read(strm, ropts);
+	}
+
 	void load_files(std::string fst_in_filename, std::string words_in_filename)
 	{
 		if (decode_fst_) delete decode_fst_;
-		decode_fst_ = fst::ReadFstKaldi(fst_in_filename);
+		decode_fst_ = read_graph(fst_in_filename);
 		if (!decode_fst_)
 			KALDI_ERR << "Could not read decoding graph from file " << fst_in_filename;
 
@@ -87,136 +118,760 @@ struct LatticeDecoderOptions
 
 }; // struct LatticeDecoderOptions
 
-// global instance
-LatticeDecoderOptions latgen_opts;
+// decoder handles, each owning its own graph, symbol table and options,
+// handed over to python as opaque integer ids
+std::mutex handles_mutex;
+std::map<int, std::shared_ptr<LatticeDecoderOptions> > handles;
+int next_handle = 1;
+
+template <class T>
+int add_object(std::map<int, std::shared_ptr<T> > &objects, std::shared_ptr<T> object)
+{
+	std::lock_guard<std::mutex> lock(handles_mutex);
+	int id = next_handle++;
+	objects[id] = object;
+	return id;
+}
+
+template <class T>
+std::shared_ptr<T> get_object(std::map<int, std::shared_ptr<T> > &objects, int id)
+{
+	std::lock_guard<std::mutex> lock(handles_mutex);
+	auto it = objects.find(id);
+	if (it == objects.end())
+		return std::shared_ptr<T>();
+	return it->second;
+}
+
+template <class T>
+int remove_object(std::map<int, std::shared_ptr<T> > &objects, int id)
+{
+	std::lock_guard<std::mutex> lock(handles_mutex);
+	// the object is freed when the last call using it returns
+	return objects.erase(id) ? 1 : 0;
+}
+
+std::shared_ptr<LatticeDecoderOptions> get_handle(int handle)
+{
+	return get_object(handles, handle);
+}
+
+// a strided view on the log-likelihoods of an utterance, pointing into the tensor storage
+struct LoglikesView
+{
+	const float *data_ = NULL;
+	int32 num_frames_ = 0;
+	int32 num_classes_ = 0;
+	int64 frame_stride_ = 0;
+	int64 class_stride_ = 1;
+};
+
+// decodable reading the log-likelihoods directly from the tensor memory with any strides,
+// instead of copying them into a kaldi::Matrix as DecodableMatrixScaled needs
+class DecodableTensorScaled : public DecodableInterface
+{
+	private:
+		const LoglikesView &view_;
+		BaseFloat scale_;
+
+	public:
+		DecodableTensorScaled(const LoglikesView &view, BaseFloat scale)
+		: view_(view),
+		  scale_(scale)
+		{}
+
+		// the indices are one-based, as the transition-ids of DecodableMatrixScaled
+		virtual BaseFloat LogLikelihood(int32 frame, int32 index)
+		{
+			return scale_ * view_.data_[frame * view_.frame_stride_ + (index - 1) * view_.class_stride_];
+		}
+
+		virtual int32 NumFramesReady() const { return view_.num_frames_; }
+
+		virtual bool IsLastFrame(int32 frame) const
+		{
+			KALDI_ASSERT(frame < NumFramesReady());
+			return (frame == NumFramesReady() - 1);
+		}
+
+		virtual int32 NumIndices() const { return view_.num_classes_; }
+
+}; // class DecodableTensorScaled
 
 struct LatticeDecoderResult
 {
 	std::vector<int32> alignments_;
 	std::vector<int32> words_;
-	std::string text_;
+	BaseFloat cost_ = 0.0;
 	bool failed_ = false;
 	bool partial_ = false;
 };
 
+// gets the best path decoded so far into res; without the final probs, the best partial
+// path among the active tokens is taken, e.g. in the middle of an online utterance
+void get_best_path(FasterDecoder &decoder, LatticeDecoderOptions &opts,
+				   LatticeDecoderResult &res, bool use_final_probs = true)
+{
+	VectorFst<LatticeArc> decoded;  // linear FST.
+
+	bool reached_final = use_final_probs && decoder.ReachedFinal();
+	if ((opts.allow_partial_ || reached_final || !use_final_probs)
+		&& decoder.GetBestPath(&decoded, use_final_probs)) {
+		res.partial_ = !reached_final;
+		LatticeWeight weight;
+		GetLinearSymbolSequence(decoded, &res.alignments_, &res.words_, &weight);
+		// graph + acoustic cost of the path; the words are looked up on the python side
+		res.cost_ = weight.Value1() + weight.Value2();
+	} else {
+		res.failed_ = true;
+	}
+}
+
+// determinized lattice of an utterance, with the words as the arc labels
+// and the token alignments in the weights
+struct DecodedLattice
+{
+	CompactLattice clat_;
+	bool partial_ = false;
+};
+
+void get_lattice_best_path(const DecodedLattice &lat, LatticeDecoderResult &res)
+{
+	CompactLattice best_clat;
+	CompactLatticeShortestPath(lat.clat_, &best_clat);
+	if (best_clat.NumStates() == 0) {
+		res.failed_ = true;
+		return;
+	}
+	Lattice best;
+	ConvertLattice(best_clat, &best);
+	LatticeWeight weight;
+	GetLinearSymbolSequence(best, &res.alignments_, &res.words_, &weight);
+	res.cost_ = weight.Value1() + weight.Value2();
+	res.partial_ = lat.partial_;
+}
+
 class LatticeDecoder
 {
 	private:
 		LatticeDecoderOptions &opts_;
-		FasterDecoder decoder_;
+		int num_threads_;
+
+		void decode_one(FasterDecoder &decoder, const LoglikesView &loglikes,
+						LatticeDecoderResult &res)
+		{
+			if (loglikes.num_frames_ == 0) {
+				res.failed_ = true;
+				return;
+			}
+
+			DecodableTensorScaled decodable(loglikes, opts_.acoustic_scale_);
+			decoder.Decode(&decodable);
+			get_best_path(decoder, opts_, res);
+		}
+
+		std::shared_ptr<DecodedLattice> decode_lattice_one(LatticeFasterDecoder &decoder,
+														  const LoglikesView &loglikes,
+														  BaseFloat lattice_beam)
+		{
+			if (loglikes.num_frames_ == 0)
+				return nullptr;
+
+			DecodableTensorScaled decodable(loglikes, opts_.acoustic_scale_);
+			if (!decoder.Decode(&decodable))
+				return nullptr;
+			bool reached_final = decoder.ReachedFinal();
+			if (!reached_final && !opts_.allow_partial_)
+				return nullptr;
+
+			Lattice lat;
+			decoder.GetRawLattice(&lat, reached_final);
+			if (lat.NumStates() == 0)
+				return nullptr;
+			fst::Connect(&lat);
+			if (lat.Properties(fst::kTopSorted, true) == 0)
+				fst::TopSort(&lat);
+			// the words go to the input side, on which the lattice is determinized
+			fst::Invert(&lat);
+
+			std::shared_ptr<DecodedLattice> res(new DecodedLattice());
+			fst::DeterminizeLatticePrunedOptions det_opts;
+			fst::DeterminizeLatticePruned(lat, lattice_beam, &res->clat_, det_opts);
+			if (res->clat_.NumStates() == 0)
+				return nullptr;
+			res->partial_ = !reached_final;
+			return res;
+		}
+
+		// runs worker on up to num_threads_ threads, which take the utterances from
+		// the shared counter until the batch is done
+		void run(int num_jobs, std::function<void(std::atomic<int> &)> worker)
+		{
+			std::atomic<int> next(0);
+			int num_threads = std::min<int>(num_threads_, num_jobs);
+			if (num_threads <= 1) {
+				worker(next);
+				return;
+			}
+			std::vector<std::thread> threads;
+			for (int t = 0; t < num_threads; t++)
+				threads.emplace_back(worker, std::ref(next));
+			for (auto &t : threads)
+				t.join();
+		}
+
+		// each worker has its own decoder on the graph shared read-only by all the workers
+		void worker(std::vector<LoglikesView> &loglikes_list,
+					std::vector<LatticeDecoderResult> &result,
+					std::atomic<int> &next)
+		{
+			FasterDecoder decoder(*opts_.decode_fst_, opts_.decoder_opts_);
+			for (int i = next++; i < loglikes_list.size(); i = next++) {
+				try {
+					decode_one(decoder, loglikes_list[i], result[i]);
+				} catch (const std::exception &e) {
+					result[i] = LatticeDecoderResult();
+					result[i].failed_ = true;
+				}
+			}
+		}
+
+		void lattice_worker(std::vector<LoglikesView> &loglikes_list,
+							std::vector<std::shared_ptr<DecodedLattice> > &result,
+							const LatticeFasterDecoderConfig &config,
+							std::atomic<int> &next)
+		{
+			LatticeFasterDecoder decoder(*opts_.decode_fst_, config);
+			for (int i = next++; i < loglikes_list.size(); i = next++) {
+				try {
+					result[i] = decode_lattice_one(decoder, loglikes_list[i], config.lattice_beam);
+				} catch (const std::exception &e) {
+					result[i].reset();
+				}
+			}
+		}
 
 	public:
-		LatticeDecoder(LatticeDecoderOptions &opts)
+		LatticeDecoder(LatticeDecoderOptions &opts, int num_threads = 1)
 		: opts_(opts),
-		  decoder_(*opts_.decode_fst_, opts_.decoder_opts_)
+		  num_threads_(num_threads > 0 ? num_threads : 1)
 		{}
 
-		int decode(std::vector<Matrix<BaseFloat> > &loglikes_list,
+		int decode(std::vector<LoglikesView> &loglikes_list,
 				   std::vector<LatticeDecoderResult> &result)
 		{
+			result.clear();
+			result.resize(loglikes_list.size());
+			run(loglikes_list.size(), [&](std::atomic<int> &next) {
+				worker(loglikes_list, result, next);
+			});
+
 			int num_fail = 0;
+			for (auto &res : result)
+				if (res.failed_) num_fail++;
+			return num_fail;
+		}
 
-			for (auto &loglikes : loglikes_list) {
-				result.emplace_back(LatticeDecoderResult());
-				LatticeDecoderResult &res = result.back();
+		// decodes with LatticeFasterDecoder into the word lattices pruned by lattice_beam,
+		// the failed utterances are left null
+		int decode_lattices(std::vector<LoglikesView> &loglikes_list, BaseFloat lattice_beam,
+							std::vector<std::shared_ptr<DecodedLattice> > &result)
+		{
+			LatticeFasterDecoderConfig config;
+			config.beam = opts_.decoder_opts_.beam;
+			config.max_active = opts_.decoder_opts_.max_active;
+			config.min_active = opts_.decoder_opts_.min_active;
+			config.beam_delta = opts_.decoder_opts_.beam_delta;
+			config.hash_ratio = opts_.decoder_opts_.hash_ratio;
+			config.lattice_beam = lattice_beam;
+
+			result.clear();
+			result.resize(loglikes_list.size());
+			run(loglikes_list.size(), [&](std::atomic<int> &next) {
+				lattice_worker(loglikes_list, result, config, next);
+			});
 
-				if (loglikes.NumRows() == 0) {
-					num_fail++;
-					res.failed_ = true;
-					continue;
-				}
+			int num_fail = 0;
+			for (auto &res : result)
+				if (!res) num_fail++;
+			return num_fail;
+		}
 
-				DecodableMatrixScaled decodable(loglikes, opts_.acoustic_scale_);
-				decoder_.Decode(&decodable);
+}; // class LatticeDecoder
 
-				VectorFst<LatticeArc> decoded;  // linear FST.
 
-				if ((opts_.allow_partial_ || decoder_.ReachedFinal())
-					&& decoder_.GetBestPath(&decoded)) {
-					res.partial_ = !decoder_.ReachedFinal();
-					LatticeWeight weight;
-					GetLinearSymbolSequence(decoded, &res.alignments_, &res.words_, &weight);
+// decodable of an online utterance, whose log-likelihoods arrive in chunks; the frames
+// already decoded are discarded, so the memory is bounded by the chunk size
+class DecodableChunked : public DecodableInterface
+{
+	private:
+		std::vector<BaseFloat> data_;
+		int32 first_frame_ = 0;
+		int32 num_frames_ = 0;
+		int32 num_classes_ = 0;
+		BaseFloat scale_;
+		bool finished_ = false;
 
-					std::stringstream ss;
-					for (auto w : res.words_)
-						ss << opts_.word_syms_->Find(w) << ' ';
-					res.text_ = ss.str().substr(0, ss.str().length()-1);
-				} else {
-					num_fail++;
-					res.failed_ = true;
-				}
-			}
+	public:
+		DecodableChunked(BaseFloat scale)
+		: scale_(scale)
+		{}
 
-			return num_fail;
+		void append(const LoglikesView &chunk)
+		{
+			if (num_classes_ == 0)
+				num_classes_ = chunk.num_classes_;
+			KALDI_ASSERT(chunk.num_classes_ == num_classes_);
+			for (int32 t = 0; t < chunk.num_frames_; t++)
+				for (int32 c = 0; c < num_classes_; c++)
+					data_.push_back(chunk.data_[t * chunk.frame_stride_ + c * chunk.class_stride_]);
+			num_frames_ += chunk.num_frames_;
 		}
 
-}; // class LatticeDecoder
+		void discard(int32 num_frames_decoded)
+		{
+			int32 n = num_frames_decoded - first_frame_;
+			if (n <= 0) return;
+			data_.erase(data_.begin(), data_.begin() + n * num_classes_);
+			first_frame_ = num_frames_decoded;
+		}
 
+		void finish() { finished_ = true; }
 
-#ifdef __cplusplus
-extern "C"
-{
-#endif
+		virtual BaseFloat LogLikelihood(int32 frame, int32 index)
+		{
+			KALDI_ASSERT(frame >= first_frame_);
+			return scale_ * data_[(frame - first_frame_) * num_classes_ + index - 1];
+		}
 
-int initialize(float beam, int max_active, int min_active,
-                           float acoustic_scale, int allow_partial,
-                           char* fst_in_filename, char* words_in_filename)
+		virtual int32 NumFramesReady() const { return num_frames_; }
+
+		virtual bool IsLastFrame(int32 frame) const
+		{
+			return finished_ && (frame == num_frames_ - 1);
+		}
+
+		virtual int32 NumIndices() const { return num_classes_; }
+
+}; // class DecodableChunked
+
+// online decoding session of an utterance on a decoder handle, advanced chunk by chunk
+// with FasterDecoder::AdvanceDecoding
+class OnlineSession
 {
-	latgen_opts.acoustic_scale_ = acoustic_scale;
-	latgen_opts.allow_partial_ = allow_partial;
+	private:
+		std::shared_ptr<LatticeDecoderOptions> opts_;
+		FasterDecoder decoder_;
+		DecodableChunked decodable_;
 
-	latgen_opts.update_decoder_options(beam, max_active, min_active);
-	latgen_opts.load_files(fst_in_filename, words_in_filename);
+	public:
+		OnlineSession(std::shared_ptr<LatticeDecoderOptions> opts)
+		: opts_(opts),
+		  decoder_(*opts->decode_fst_, opts->decoder_opts_),
+		  decodable_(opts->acoustic_scale_)
+		{
+			decoder_.InitDecoding();
+		}
 
-	return 1;
+		int32 advance(const LoglikesView &chunk)
+		{
+			decodable_.append(chunk);
+			decoder_.AdvanceDecoding(&decodable_);
+			decodable_.discard(decoder_.NumFramesDecoded());
+			return decoder_.NumFramesDecoded();
+		}
+
+		void partial(LatticeDecoderResult &res)
+		{
+			if (decoder_.NumFramesDecoded() == 0) {
+				res.partial_ = true;
+				return;
+			}
+			get_best_path(decoder_, *opts_, res, false);
+		}
+
+		void finalize(LatticeDecoderResult &res)
+		{
+			decodable_.finish();
+			if (decoder_.NumFramesDecoded() == 0) {
+				res.failed_ = true;
+				return;
+			}
+			get_best_path(decoder_, *opts_, res, true);
+		}
+
+}; // class OnlineSession
+
+std::map<int, std::shared_ptr<OnlineSession> > sessions;
+
+std::shared_ptr<OnlineSession> get_session(int session)
+{
+	return get_object(sessions, session);
 }
 
-int decode(THFloatTensor *loglikes, THIntTensor *words, THIntTensor *alignments)
+// second-pass rescoring of the lattices, as lattice-lmrescore and lattice-lmrescore-const-arpa do:
+// the scores of the first-pass LM (G.fst) are subtracted, and the scores of the new LM,
+// either an fst or a const-ARPA LM, are added
+class LatticeRescorer
 {
-	LatticeDecoder decoder(latgen_opts);
+	private:
+		VectorFst<LatticeArc> old_lm_;
+		VectorFst<LatticeArc> new_lm_;
+		ConstArpaLm const_arpa_;
+		bool has_old_lm_ = false;
+		bool use_const_arpa_ = false;
 
-	std::vector<Matrix<BaseFloat> > loglikes_list;
-	std::vector<LatticeDecoderResult> results;
+		static void read_lm_fst(std::string filename, VectorFst<LatticeArc> *lm_fst)
+		{
+			VectorFst<StdArc> *std_lm_fst = fst::ReadFstKaldi(filename);
+			// the projection turns the #0 backoff input labels of G.fst into epsilons, so the fst
+			// is sorted after it, as lmrescore.sh projects G.fst before lattice-lmrescore sorts it
+			fst::Project(std_lm_fst, fst::PROJECT_OUTPUT);
+			if (std_lm_fst->Properties(fst::kILabelSorted, true) == 0)
+				fst::ArcSort(std_lm_fst, fst::ILabelCompare<StdArc>());
+			fst::ArcMap(*std_lm_fst, lm_fst, fst::StdToLatticeMapper<BaseFloat>());
+			delete std_lm_fst;
+		}
+
+		// composes with the LM fst, whose scores are scaled by lm_scale, e.g. -1 to remove them
+		static void compose_lm(CompactLattice *clat, const VectorFst<LatticeArc> &lm_fst,
+							   BaseFloat lm_scale)
+		{
+			fst::ScaleLattice(fst::GraphLatticeScale(1.0 / lm_scale), clat);
+			fst::ArcSort(clat, fst::OLabelCompare<CompactLatticeArc>());
+			Lattice lat;
+			ConvertLattice(*clat, &lat);
+			fst::ArcSort(&lat, fst::OLabelCompare<LatticeArc>());
+
+			Lattice composed_lat;
+			fst::TableComposeOptions compose_opts(fst::TableMatcherOptions(), 0, fst::MATCH_INPUT);
+			fst::TableCompose(lat, lm_fst, &composed_lat, compose_opts);
+			fst::Invert(&composed_lat);
+			fst::DeterminizeLattice(composed_lat, clat);
+			fst::ScaleLattice(fst::GraphLatticeScale(lm_scale), clat);
+		}
 
-	// convert at::Tensor to list of kaldi::SubMatrix
+		void compose_const_arpa(CompactLattice *clat, BaseFloat lm_scale)
+		{
+			fst::ScaleLattice(fst::GraphLatticeScale(1.0 / lm_scale), clat);
+			ConstArpaLmDeterministicFst const_arpa_fst(const_arpa_);
+			CompactLattice composed_clat;
+			ComposeCompactLatticeDeterministic(*clat, &const_arpa_fst, &composed_clat);
+
+			Lattice composed_lat;
+			ConvertLattice(composed_clat, &composed_lat);
+			fst::Invert(&composed_lat);
+			fst::DeterminizeLattice(composed_lat, clat);
+			fst::ScaleLattice(fst::GraphLatticeScale(lm_scale), clat);
+		}
+
+	public:
+		// old_lm_filename may be empty to only add the scores of the new LM
+		LatticeRescorer(std::string old_lm_filename, std::string new_lm_filename, bool const_arpa)
+		: has_old_lm_(!old_lm_filename.empty()),
+		  use_const_arpa_(const_arpa)
+		{
+			if (has_old_lm_)
+				read_lm_fst(old_lm_filename, &old_lm_);
+			if (use_const_arpa_)
+				ReadKaldiObject(new_lm_filename, &const_arpa_);
+			else
+				read_lm_fst(new_lm_filename, &new_lm_);
+		}
+
+		std::shared_ptr<DecodedLattice> rescore(const DecodedLattice &lat)
+		{
+			std::shared_ptr<DecodedLattice> res(new DecodedLattice(lat));
+			if (has_old_lm_)
+				compose_lm(&res->clat_, old_lm_, -1.0);
+			if (res->clat_.NumStates() == 0)
+				return nullptr;
+			if (use_const_arpa_)
+				compose_const_arpa(&res->clat_, 1.0);
+			else
+				compose_lm(&res->clat_, new_lm_, 1.0);
+			if (res->clat_.NumStates() == 0)
+				return nullptr;
+			return res;
+		}
+
+}; // class LatticeRescorer
+
+std::map<int, std::shared_ptr<DecodedLattice> > lattices;
+std::map<int, std::shared_ptr<LatticeRescorer> > rescorers;
+
+// returns the views of the valid frames of the utterances in a N x R x C tensor, or false
+// if the lengths do not match the batch
+bool views_of_batch(THFloatTensor *loglikes, THIntTensor *lengths,
+					std::vector<LoglikesView> &loglikes_list)
+{
+	// views on the tensor storage, so neither a contiguous tensor nor a copy is needed
 	int num_batch = THFloatTensor_size(loglikes, 0);
 	int num_frame = THFloatTensor_size(loglikes, 1);
 	int num_class = THFloatTensor_size(loglikes, 2);
 
 	float *l_data = THFloatTensor_data(loglikes);
+	int64 batch_stride = THFloatTensor_stride(loglikes, 0);
+
+	// only the valid frames of each utterance are decoded, the padded tail is skipped;
+	// an empty lengths tensor means every utterance has num_frame frames
+	bool has_lengths = THIntTensor_nElement(lengths) > 0;
+	if (has_lengths && THIntTensor_size(lengths, 0) != num_batch)
+		return false;
 
 	for (int i = 0; i < num_batch; i++) {
-		int s = i * num_frame * num_class;
-		loglikes_list.emplace_back(SubMatrix<BaseFloat>(l_data + s, num_frame, num_class, num_class));
+		LoglikesView view;
+		view.data_ = l_data + i * batch_stride;
+		view.num_frames_ = num_frame;
+		if (has_lengths)
+			view.num_frames_ = std::max(0, std::min(num_frame, (int)THIntTensor_get1d(lengths, i)));
+		view.num_classes_ = num_class;
+		view.frame_stride_ = THFloatTensor_stride(loglikes, 1);
+		view.class_stride_ = THFloatTensor_stride(loglikes, 2);
+		loglikes_list.push_back(view);
+	}
+	return true;
+}
+
+// ragged outputs: the values of all the utterances concatenated, with num_batch + 1 offsets
+void write_results(std::vector<LatticeDecoderResult> &results,
+				   THIntTensor *words, THIntTensor *word_offsets,
+				   THIntTensor *alignments, THIntTensor *alignment_offsets,
+				   THFloatTensor *costs, THIntTensor *partial, THIntTensor *failed)
+{
+	int num_words = 0, num_alignments = 0;
+	for (auto &r : results) {
+		num_words += r.words_.size();
+		num_alignments += r.alignments_.size();
+	}
+
+	THIntTensor_resize1d(words, num_words);
+	THIntTensor_resize1d(word_offsets, results.size() + 1);
+	THIntTensor_resize1d(alignments, num_alignments);
+	THIntTensor_resize1d(alignment_offsets, results.size() + 1);
+	THFloatTensor_resize1d(costs, results.size());
+	THIntTensor_resize1d(partial, results.size());
+	THIntTensor_resize1d(failed, results.size());
+
+	int *w_data = THIntTensor_data(words);
+	int *wo_data = THIntTensor_data(word_offsets);
+	int *a_data = THIntTensor_data(alignments);
+	int *ao_data = THIntTensor_data(alignment_offsets);
+	float *c_data = THFloatTensor_data(costs);
+	int *p_data = THIntTensor_data(partial);
+	int *f_data = THIntTensor_data(failed);
+
+	wo_data[0] = ao_data[0] = 0;
+	for (int i = 0; i < results.size(); i++) {
+		auto &r = results[i];
+		std::copy(r.words_.begin(), r.words_.end(), w_data + wo_data[i]);
+		wo_data[i + 1] = wo_data[i] + r.words_.size();
+		std::copy(r.alignments_.begin(), r.alignments_.end(), a_data + ao_data[i]);
+		ao_data[i + 1] = ao_data[i] + r.alignments_.size();
+		c_data[i] = r.failed_ ? std::numeric_limits<float>::infinity() : r.cost_;
+		p_data[i] = r.partial_;
+		f_data[i] = r.failed_;
+	}
+}
+
+LoglikesView view_of_chunk(THFloatTensor *loglikes)
+{
+	LoglikesView view;
+	view.data_ = THFloatTensor_data(loglikes);
+	view.num_frames_ = THFloatTensor_size(loglikes, 0);
+	view.num_classes_ = THFloatTensor_size(loglikes, 1);
+	view.frame_stride_ = THFloatTensor_stride(loglikes, 0);
+	view.class_stride_ = THFloatTensor_stride(loglikes, 1);
+	return view;
+}
+
+void copy_to_tensor(const std::vector<int32> &values, THIntTensor *tensor)
+{
+	THIntTensor_resize1d(tensor, values.size());
+	int j = 0;
+	for (auto v : values)
+		THIntTensor_set1d(tensor, j++, v);
+}
+
+
+#ifdef __cplusplus
+extern "C"
+{
+#endif
+
+int create_decoder(float beam, int max_active, int min_active,
+				   float acoustic_scale, int allow_partial,
+				   char* fst_in_filename, char* words_in_filename)
+{
+	std::shared_ptr<LatticeDecoderOptions> opts(new LatticeDecoderOptions());
+	opts->acoustic_scale_ = acoustic_scale;
+	opts->allow_partial_ = allow_partial;
+
+	opts->update_decoder_options(beam, max_active, min_active);
+	try {
+		opts->load_files(fst_in_filename, words_in_filename);
+	} catch (const std::exception &e) {
+		return 0;
 	}
 
+	return add_object(handles, opts);
+}
+
+int destroy_decoder(int handle)
+{
+	return remove_object(handles, handle);
+}
+
+int decode(int handle, THFloatTensor *loglikes, THIntTensor *lengths,
+		   THIntTensor *words, THIntTensor *word_offsets,
+		   THIntTensor *alignments, THIntTensor *alignment_offsets,
+		   THFloatTensor *costs, THIntTensor *partial, THIntTensor *failed,
+		   int num_threads)
+{
+	std::shared_ptr<LatticeDecoderOptions> opts = get_handle(handle);
+	if (!opts)
+		return 0;
+	LatticeDecoder decoder(*opts, num_threads);
+
+	std::vector<LoglikesView> loglikes_list;
+	std::vector<LatticeDecoderResult> results;
+	if (!views_of_batch(loglikes, lengths, loglikes_list))
+		return 0;
+
 	// decode
 	decoder.decode(loglikes_list, results);
 
-	// get max length
-	int max_words = 0, max_alignments = 0;
-	for (auto &r : results) {
-		if (r.failed_) continue;
-		if (max_words < r.words_.size())
-			max_words = r.words_.size();
-		if (max_alignments < r.alignments_.size())
-			max_alignments = r.alignments_.size();
-	}
+	write_results(results, words, word_offsets, alignments, alignment_offsets, costs, partial, failed);
+	return 1;
+}
 
-	THIntTensor_resize2d(words, results.size(), max_words);
-	THIntTensor_resize2d(alignments, results.size(), max_alignments);
+int create_session(int handle)
+{
+	std::shared_ptr<LatticeDecoderOptions> opts = get_handle(handle);
+	if (!opts)
+		return 0;
+	return add_object(sessions, std::shared_ptr<OnlineSession>(new OnlineSession(opts)));
+}
+
+int destroy_session(int session)
+{
+	return remove_object(sessions, session);
+}
+
+int advance_session(int session, THFloatTensor *loglikes)
+{
+	std::shared_ptr<OnlineSession> s = get_session(session);
+	if (!s)
+		return -1;
+	return s->advance(view_of_chunk(loglikes));
+}
 
+int get_partial(int session, THIntTensor *words, THIntTensor *alignments)
+{
+	std::shared_ptr<OnlineSession> s = get_session(session);
+	if (!s)
+		return 0;
+	LatticeDecoderResult res;
+	s->partial(res);
+	copy_to_tensor(res.words_, words);
+	copy_to_tensor(res.alignments_, alignments);
+	return res.failed_ ? 0 : 1;
+}
+
+int finalize_session(int session, THIntTensor *words, THIntTensor *alignments)
+{
+	std::shared_ptr<OnlineSession> s = get_session(session);
+	if (!s)
+		return 0;
+	LatticeDecoderResult res;
+	s->finalize(res);
+	copy_to_tensor(res.words_, words);
+	copy_to_tensor(res.alignments_, alignments);
+	return res.failed_ ? 0 : 1;
+}
+
+int decode_lattices(int handle, THFloatTensor *loglikes, THIntTensor *lengths,
+					THIntTensor *lattice_ids, float lattice_beam, int num_threads)
+{
+	std::shared_ptr<LatticeDecoderOptions> opts = get_handle(handle);
+	if (!opts)
+		return 0;
+	LatticeDecoder decoder(*opts, num_threads);
+
+	std::vector<LoglikesView> loglikes_list;
+	std::vector<std::shared_ptr<DecodedLattice> > results;
+	if (!views_of_batch(loglikes, lengths, loglikes_list))
+		return 0;
+
+	decoder.decode_lattices(loglikes_list, lattice_beam, results);
+
+	// the lattices stay in the extension, referred by their ids (0 if failed)
+	THIntTensor_resize1d(lattice_ids, results.size());
+	for (int i = 0; i < results.size(); i++)
+		THIntTensor_set1d(lattice_ids, i, results[i] ? add_object(lattices, results[i]) : 0);
+	return 1;
+}
+
+int destroy_lattices(THIntTensor *lattice_ids)
+{
+	int n = 0;
+	for (int i = 0; i < THIntTensor_nElement(lattice_ids); i++)
+		n += remove_object(lattices, THIntTensor_get1d(lattice_ids, i));
+	return n;
+}
+
+int lattice_best_paths(THIntTensor *lattice_ids,
+					   THIntTensor *words, THIntTensor *word_offsets,
+					   THIntTensor *alignments, THIntTensor *alignment_offsets,
+					   THFloatTensor *costs, THIntTensor *partial, THIntTensor *failed)
+{
+	std::vector<LatticeDecoderResult> results(THIntTensor_nElement(lattice_ids));
 	for (int i = 0; i < results.size(); i++) {
-		if (results[i].failed_) continue;
-		//strncpy(texts[i], results[i].text_.c_str(), results[i].text_.length());
-		int j = 0;
-		for (auto w : results[i].words_)
-			THIntTensor_set2d(words, i, j++, w);
-		j = 0;
-		for (auto a : results[i].alignments_)
-			THIntTensor_set2d(alignments, i, j++, a);
+		std::shared_ptr<DecodedLattice> lat = get_object(lattices, THIntTensor_get1d(lattice_ids, i));
+		if (lat)
+			get_lattice_best_path(*lat, results[i]);
+		else
+			results[i].failed_ = true;
 	}
+	write_results(results, words, word_offsets, alignments, alignment_offsets, costs, partial, failed);
+	return 1;
+}
+
+int create_rescorer(char *old_lm_filename, char *new_lm_filename, int const_arpa)
+{
+	try {
+		std::shared_ptr<LatticeRescorer> rescorer(
+			new LatticeRescorer(old_lm_filename, new_lm_filename, const_arpa));
+		return add_object(rescorers, rescorer);
+	} catch (const std::exception &e) {
+		return 0;
+	}
+}
 
+int destroy_rescorer(int rescorer)
+{
+	return remove_object(rescorers, rescorer);
+}
+
+int rescore_lattices(int rescorer, THIntTensor *lattice_ids, THIntTensor *rescored_ids)
+{
+	std::shared_ptr<LatticeRescorer> r = get_object(rescorers, rescorer);
+	if (!r)
+		return 0;
+
+	int n = THIntTensor_nElement(lattice_ids);
+	THIntTensor_resize1d(rescored_ids, n);
+	for (int i = 0; i < n; i++) {
+		std::shared_ptr<DecodedLattice> lat = get_object(lattices, THIntTensor_get1d(lattice_ids, i));
+		std::shared_ptr<DecodedLattice> res;
+		try {
+			if (lat)
+				res = r->rescore(*lat);
+		} catch (const std::exception &e) {
+			res.reset();
+		}
+		THIntTensor_set1d(rescored_ids, i, res ? add_object(lattices, res) : 0);
+	}
 	return 1;
 }
 
@@ -1,4 +1,24 @@
-int initialize(float beam, int max_active, int min_active,
-                float acoustic_scale, int allow_partial,
-                char* fst_in_filename, char* words_in_filename);
-int decode(THFloatTensor *loglikes, THIntTensor *words, THIntTensor *alignments);
+int create_decoder(float beam, int max_active, int min_active,
+                   float acoustic_scale, int allow_partial,
+                   char* fst_in_filename, char* words_in_filename);
+int destroy_decoder(int handle);
+int decode(int handle, THFloatTensor *loglikes, THIntTensor *lengths,
+           THIntTensor *words, THIntTensor *word_offsets,
+           THIntTensor *alignments, THIntTensor *alignment_offsets,
+           THFloatTensor *costs, THIntTensor *partial, THIntTensor *failed,
+           int num_threads);
+int create_session(int handle);
+int destroy_session(int session);
+int advance_session(int session, THFloatTensor *loglikes);
+int get_partial(int session, THIntTensor *words, THIntTensor *alignments);
+int finalize_session(int session, THIntTensor *words, THIntTensor *alignments);
+int decode_lattices(int handle, THFloatTensor *loglikes, THIntTensor *lengths,
+                    THIntTensor *lattice_ids, float lattice_beam, int num_threads);
+int destroy_lattices(THIntTensor *lattice_ids);
+int lattice_best_paths(THIntTensor *lattice_ids,
+                       THIntTensor *words, THIntTensor *word_offsets,
+                       THIntTensor *alignments, THIntTensor *alignment_offsets,
+                       THFloatTensor *costs, THIntTensor *partial, THIntTensor *failed);
+int create_rescorer(char *old_lm_filename, char *new_lm_filename, int const_arpa);
+int destroy_rescorer(int rescorer);
+int rescore_lattices(int rescorer, THIntTensor *lattice_ids, THIntTensor *rescored_ids);
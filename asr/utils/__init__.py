@@ -3,3 +3,7 @@ from . import kaldi_io
 from . import logger
 from . import params
 from . import misc
+from . import shard
+from . import prep_state
+from . import kaldi_dataset
+from . import ctc_decoder
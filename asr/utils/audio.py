@@ -62,6 +62,9 @@ class Augment(object):
         self.noise_range = noise_range
 
     def __call__(self, wav_file, tar_file=None):
+        if isinstance(wav_file, np.ndarray):
+            return self._augment_samples(wav_file, tar_file)
+
         if not Path(wav_file).exists():
             raise IOError
 
@@ -92,10 +95,28 @@ class Augment(object):
             tfm.build(str(wav_file), str(tar_file))
             sr, wav = sp.io.wavfile.read(tar_file)
 
-        if self.noise:
-            noise = np.random.normal(0, 1, wav.shape)  # TODO: noise range?
-            wav += noise
-        return wav
+        return self._add_noise(wav)
+
+    def _add_noise(self, wav):
+        if not self.noise:
+            return wav
+        # the int16 pcm is converted not to be cast in place
+        noise = np.random.normal(0, 1, wav.shape)  # TODO: noise range?
+        return wav.astype(np.float64) + noise
+
+    def _augment_samples(self, samples, tar_file=None):
+        # raw pcm samples at self.sample_rate, e.g. read from a shard
+        if not (self.resample or self.tempo or self.gain):
+            return self._add_noise(np.array(samples))
+        # sox needs a file to apply the effects
+        tmp_dir = tmp._get_default_tempdir()
+        tmp_name = next(tmp._get_candidate_names())
+        tmp_file = Path(tmp_dir, tmp_name + ".wav")
+        sp.io.wavfile.write(tmp_file, self.sample_rate, samples)
+        try:
+            return self(tmp_file, tar_file)
+        finally:
+            os.unlink(tmp_file)
 
 
 # transformer: spectrogram
@@ -161,6 +182,16 @@ class Int2OneHot(object):
         return one_hots
 
 
+def match_length(tensors, targets):
+    # manipulating when the length of data and targets are mismatched
+    l0, l1 = len(tensors), len(targets)
+    if l0 > l1:
+        tensors = tensors[:l1]
+    elif l0 < l1:
+        tensors.extend([torch.zeros_like(tensors[0]) for i in range(l1 - l0)])
+    return tensors, targets
+
+
 class AudioDataset(Dataset):
 
     def __init__(self,
@@ -235,6 +266,30 @@ class AudioCollateFn(object):
         return batch
 
 
+class CtcCollateFn(object):
+    """
+    collates the whole utterances of the indices into (features, lengths, targets, target_lengths),
+    where features is N x T x D padded with zeros to the longest T, and targets is the flat
+    concatenation of the token id sequences; (features, lengths) if there is no target
+    """
+
+    def __call__(self, dataset, indices):
+        tensors, targets = list(), list()
+        for idx in indices:
+            tensor, target = dataset[idx]
+            tensors.append(torch.stack(tensor))
+            if target is not None:
+                targets.append(torch.IntTensor(np.asarray(target, dtype=np.int32)))
+        lengths = torch.IntTensor([len(x) for x in tensors])
+        features = tensors[0].new_zeros((len(tensors), int(lengths.max()), tensors[0].shape[1]))
+        for i, x in enumerate(tensors):
+            features[i, :len(x)] = x
+        if not targets:
+            return features, lengths
+        target_lengths = torch.IntTensor([len(x) for x in targets])
+        return features, lengths, torch.cat(targets), target_lengths
+
+
 def _worker_loop(dataset, index_queue, data_queue, collate_fn, seed, init_fn, worker_id):
     global _use_shared_memory
     _use_shared_memory = True
@@ -435,8 +490,12 @@ class AudioDataLoader(DataLoader):
     def __init__(self, dataset, batch_size,
                  shuffle=False, sampler=None, batch_sampler=None, num_workers=0,
                  drop_last=True, pin_memory=False, use_cuda=False, *args, **kwargs):
+        if getattr(dataset, "target_type", None) == "ctc":
+            raise ValueError("the CTC targets are not frame-aligned, use CtcDataLoader to load the utterances")
         collate_fn = AudioCollateFn()
         if batch_sampler is None:
+            if sampler is None and hasattr(dataset, "make_sampler"):
+                sampler = dataset.make_sampler(shuffle)
             if sampler is None:
                 if shuffle:
                     sampler = RandomSampler(dataset)
@@ -452,6 +511,31 @@ class AudioDataLoader(DataLoader):
         return AudioDataLoaderIter(self)
 
 
+class CtcDataLoader(DataLoader):
+    """
+    loads batches of batch_size whole utterances with their CTC targets, collated by CtcCollateFn
+    """
+
+    def __init__(self, dataset, batch_size,
+                 shuffle=False, sampler=None, batch_sampler=None, num_workers=0,
+                 drop_last=False, pin_memory=False, use_cuda=False, *args, **kwargs):
+        collate_fn = CtcCollateFn()
+        if batch_sampler is None:
+            if sampler is None:
+                if shuffle:
+                    sampler = RandomSampler(dataset)
+                else:
+                    sampler = SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.use_cuda = use_cuda
+
+        super().__init__(dataset=dataset, batch_sampler=batch_sampler, num_workers=num_workers,
+                         collate_fn=collate_fn, pin_memory=pin_memory, timeout=0, *args, **kwargs)
+
+    def __iter__(self):
+        return AudioDataLoaderIter(self)
+
+
 class PredictDataLoader:
 
     def __init__(self, dataset, use_cuda=False, *args, **kwargs):
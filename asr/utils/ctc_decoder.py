@@ -0,0 +1,428 @@
+#!python
+import math
+import collections
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+
+"""
+CTC decoders in pure numpy/torch, which need neither Kaldi nor the latgen extension
+
+The log-likelihoods are laid out as asr.kaldi.latgen.LatGenDecoder expects, i.e. N x R x C
+with the column c holding the token id c + 1 of tokens.txt, so the blank <blk> (id 1) is the column 0
+"""
+
+DEFAULT_TOKEN = (Path(__file__).parents[1] / "kaldi" / "graph" / "tokens.txt").resolve()
+NEG_INF = -float("inf")
+LOG10 = math.log(10.)
+
+
+def read_symbols(filename):
+    # Kaldi's symbol table of "symbol id" lines
+    symbols = dict()
+    with open(filename, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            sym, idx = line.strip().split()
+            symbols[int(idx)] = sym
+    return symbols
+
+
+class NgramScorer(object):
+    """Backoff n-gram LM read from an ARPA file, scoring the decoded tokens in natural log
+
+    With unit="token", every token is scored as a unit, e.g. for a character LM. With unit="word",
+    the tokens are accumulated into a word until the delimiter token, and then the word is scored.
+
+    Args:
+        arpa_file (path): ARPA LM file
+        unit (str): either one of "token" or "word"
+        delimiter (str): word delimiter token if unit is "word"
+        unk (str): symbol scored for the units not in the LM
+    """
+
+    def __init__(self, arpa_file, unit="token", delimiter="<space>", unk="<unk>"):
+        assert unit in ["token", "word"], "invalid unit options: either one of \"token\" or \"word\""
+        self.unit = unit
+        self.delimiter = delimiter
+        self.unk = unk
+        self.ngrams = dict()
+        self.order = 0
+        self._read_arpa(arpa_file)
+
+    def _read_arpa(self, arpa_file):
+        n = 0
+        with open(arpa_file, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("ngram "):
+                    continue
+                if line.startswith("\\"):
+                    n = int(line[1]) if line[1:2].isdigit() else 0
+                    self.order = max(self.order, n)
+                    continue
+                if n == 0:
+                    continue
+                fields = line.split()
+                prob = float(fields[0]) * LOG10
+                backoff = float(fields[n + 1]) * LOG10 if len(fields) > n + 1 else 0.
+                self.ngrams[tuple(fields[1:n + 1])] = (prob, backoff)
+
+    def initial_state(self):
+        # (history of the scored units, the tokens of the current word)
+        return ("<s>",), ()
+
+    def _prob(self, history, unit):
+        if (unit,) not in self.ngrams:
+            unit = self.unk
+        backoff = 0.
+        for i in range(len(history) + 1):
+            ngram = history[i:] + (unit,)
+            if ngram in self.ngrams:
+                return backoff + self.ngrams[ngram][0]
+            backoff += self.ngrams.get(history[i:], (0., 0.))[1]
+        return backoff + NEG_INF
+
+    def score(self, state, token):
+        """
+        returns the log probability of appending token to the state, and the next state
+        """
+        history, word = state
+        if self.unit == "word":
+            if token != self.delimiter:
+                return 0., (history, word + (token,))
+            if not word:
+                return 0., state
+            token = "".join(word)
+        prob = self._prob(history, token)
+        return prob, ((history + (token,))[-(self.order - 1):] if self.order > 1 else (), ())
+
+    def final(self, state):
+        """
+        returns the log probability of ending the sentence at the state
+        """
+        history, word = state
+        prob = 0.
+        if word:
+            prob, state = self.score(state, self.delimiter)
+            history = state[0]
+        return prob + self._prob(history, "</s>")
+
+
+class SymbolTable(object):
+    """Kaldi's symbol table, e.g. words.txt or tokens.txt, with vectorized id-to-symbol lookups
+
+    Args:
+        filename (path): symbol table file of "symbol id" lines
+        unk (str): symbol of the ids not in the table
+    """
+
+    def __init__(self, filename, unk="<unk>"):
+        symbols = read_symbols(filename)
+        self.symbols = np.full(max(symbols) + 2, unk, dtype=object)
+        for idx, sym in symbols.items():
+            self.symbols[idx] = sym
+
+    def __len__(self):
+        return len(self.symbols) - 1
+
+    def lookup(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        return self.symbols[np.clip(ids, 0, len(self.symbols) - 1)]
+
+    def texts(self, values, offsets):
+        """
+        converts the ragged ids (flat values and N + 1 offsets) into the N strings at once
+        """
+        syms = self.lookup(values)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        return [" ".join(x) for x in np.split(syms, offsets[1:-1])]
+
+
+class DecoderOutput(collections.namedtuple("DecoderOutput", [
+        "words", "word_offsets", "alignments", "alignment_offsets", "costs", "partial", "failed"])):
+    """Ragged outputs of a batch decoded by CtcDecoder or LatGenDecoder
+
+    The words (or tokens) and the frame alignments of the N utterances are concatenated into flat
+    int tensors, and those of the utterance i are values[offsets[i]:offsets[i + 1]].
+    costs holds the cost of the best path of every utterance (inf if failed), partial is 1 if the
+    best path did not reach a final state, and failed is 1 if nothing was decoded.
+    """
+
+    __slots__ = ()
+
+    @property
+    def batch_size(self):
+        return len(self.costs)
+
+    def words_of(self, i):
+        return self.words[self.word_offsets[i]:self.word_offsets[i + 1]]
+
+    def alignments_of(self, i):
+        return self.alignments[self.alignment_offsets[i]:self.alignment_offsets[i + 1]]
+
+    def texts(self, symbols):
+        """
+        looks up the words of all the utterances in the SymbolTable symbols
+        """
+        return symbols.texts(self.words.numpy(), self.word_offsets.numpy())
+
+
+def ragged(seqs, dtype=np.int32):
+    """
+    returns the flat values and the offsets of a list of sequences
+    """
+    offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in seqs])
+    values = np.concatenate([np.asarray(x, dtype=dtype) for x in seqs]) if seqs else np.zeros(0, dtype)
+    return values.astype(dtype), offsets.astype(np.int32)
+
+
+def ctc_align(loglikes, labels, blank=0):
+    """
+    Viterbi alignment of the column sequence labels to the T x C loglikes through the CTC topology,
+    returns the column of every frame, which is blank or one of the labels
+    """
+    T = len(loglikes)
+    ext = np.full(2 * len(labels) + 1, blank, dtype=np.int64)
+    ext[1::2] = labels
+    S = len(ext)
+    # a label state can be entered by skipping the preceding blank, unless it repeats the previous label
+    skip = np.zeros(S, dtype=bool)
+    skip[3::2] = ext[3::2] != ext[1:-2:2]
+
+    scores = np.full(S, NEG_INF)
+    scores[:2] = loglikes[0, ext[:2]]
+    back = np.zeros((T, S), dtype=np.int8)
+    for t in range(1, T):
+        stay = scores
+        step = np.concatenate(([NEG_INF], scores[:-1]))
+        jump = np.where(skip, np.concatenate(([NEG_INF, NEG_INF], scores[:-2])), NEG_INF)
+        cands = np.stack([stay, step, jump])
+        back[t] = np.argmax(cands, axis=0)
+        scores = cands[back[t], np.arange(S)] + loglikes[t, ext]
+
+    s = S - 1 if S == 1 or scores[-1] >= scores[-2] else S - 2
+    path = np.empty(T, dtype=np.int64)
+    for t in range(T - 1, -1, -1):
+        path[t] = ext[s]
+        s -= back[t, s]
+    return path
+
+
+def skip_blank_frames(loglikes, lengths, threshold, blank=0):
+    """
+    merges every run of the frames whose blank posterior exceeds threshold into its first frame,
+    so that the search goes only through the frames of the tokens and one blank frame between them.
+    the posteriors are taken by the softmax of the N x R x C loglikes over the columns
+
+    returns the compacted N x R' x C loglikes, their lengths, and the N x R index of the compacted frame
+    of every original frame, which is used by expand_alignments to map the alignments back
+    """
+    num_batch, num_frame, _ = loglikes.shape
+    with torch.no_grad():
+        lengths = lengths.long().cpu()
+        posts = torch.softmax(loglikes.float(), dim=-1)[:, :, blank].cpu()
+        valid = torch.arange(num_frame).unsqueeze(0) < lengths.unsqueeze(1)
+        skip = posts > threshold
+        skip = skip & torch.cat([torch.zeros_like(skip[:, :1]), skip[:, :-1]], dim=1)
+        keep = valid & (skip == 0)
+        index = keep.long().cumsum(dim=1) - 1
+        new_lengths = keep.long().sum(dim=1)
+        # the kept frames are scattered into their new positions; the padded frames are never searched
+        rows = torch.arange(num_batch).unsqueeze(1).expand(num_batch, num_frame)
+        compact = loglikes.new_zeros((num_batch, max(int(new_lengths.max()) if num_batch else 0, 1),
+                                      loglikes.shape[-1]))
+        keep = keep.to(loglikes.device)
+        compact[rows.to(loglikes.device)[keep], index.to(loglikes.device)[keep]] = loglikes[keep]
+    return compact, new_lengths, index
+
+
+def expand_alignments(output, index, lengths):
+    """
+    maps the frame alignments of a DecoderOutput decoded from the frames compacted by skip_blank_frames
+    back to the original lengths frames; a merged frame takes the alignment of the frame it is merged into
+    """
+    num_frame = index.shape[1]
+    lengths = lengths.long().cpu()
+    offsets = output.alignment_offsets.long()
+    # the failed utterances have no alignments to expand
+    aligned = (offsets[1:] - offsets[:-1]) > 0
+    valid = (torch.arange(num_frame).unsqueeze(0) < lengths.unsqueeze(1)) & aligned.unsqueeze(1)
+    flat = (offsets[:-1].unsqueeze(1) + index)[valid]
+    counts = valid.long().sum(dim=1)
+    alignment_offsets = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(dim=0)]).int()
+    return output._replace(alignments=output.alignments[flat], alignment_offsets=alignment_offsets)
+
+
+class CtcDecoder(object):
+    """Batched CTC greedy and prefix beam search decoder over tokens.txt
+
+    Used as LatGenDecoder, i.e. decoder(loglikes, lengths) returns a DecoderOutput of the ragged
+    decoded token ids and the ragged token ids of every valid frame, with the costs of the paths.
+    With beam_size 1, the frame-wise argmax is collapsed (greedy); otherwise the prefix beam search keeps
+    the beam_size best prefixes within beam of the best, extended by the token_beam best tokens of each frame.
+    With blank_skip, the runs of the frames whose blank posterior exceeds blank_skip are merged before
+    the search (see skip_blank_frames), and the alignments are mapped back to the original frames.
+
+    Args:
+        beam_size (int): max number of the prefixes kept, 1 for the greedy search
+        beam (float): prefixes scoring below the best minus beam are pruned
+        token_beam (int): number of the best tokens of a frame tried to extend the prefixes
+        acoustic_scale (float): scale of the log-likelihoods
+        token_file (path): Kaldi's tokens.txt containing <blk>
+        blank (str): symbol of the blank token
+        lm (NgramScorer): optional n-gram scorer of the decoded tokens
+        lm_weight (float): weight of the lm scores
+        insertion_bonus (float): score added for every decoded token
+        blank_skip (float): blank posterior threshold of the frame skipping, no skipping if None
+    """
+
+    def __init__(self, beam_size=16, beam=16.0, token_beam=8, acoustic_scale=1.0,
+                 token_file=str(DEFAULT_TOKEN), blank="<blk>",
+                 lm=None, lm_weight=0.5, insertion_bonus=0., blank_skip=None):
+        symbols = read_symbols(token_file)
+        self.num_token = len(symbols)
+        self.symbols = SymbolTable(token_file)
+        ids = {sym: idx for idx, sym in symbols.items()}
+        self.blank = ids[blank] - 1  # column of the blank
+        self.beam_size = beam_size
+        self.beam = beam
+        self.token_beam = token_beam
+        self.acoustic_scale = acoustic_scale
+        self.lm = lm
+        self.lm_weight = lm_weight
+        self.insertion_bonus = insertion_bonus
+        self.blank_skip = blank_skip
+
+    def __call__(self, loglikes, lengths=None):
+        return self.forward(loglikes, lengths)
+
+    def forward(self, loglikes, lengths=None):
+        assert loglikes.dim() == 3 and loglikes.shape[-1] == self.num_token
+        num_batch, num_frame, _ = loglikes.shape
+        if lengths is None:
+            lengths = torch.full((num_batch,), num_frame, dtype=torch.long)
+        lengths = lengths.long().cpu().clamp(0, num_frame)
+        if self.blank_skip is None:
+            return self.search(loglikes, lengths)
+        loglikes, skipped_lengths, index = skip_blank_frames(loglikes, lengths, self.blank_skip, self.blank)
+        return expand_alignments(self.search(loglikes, skipped_lengths), index, lengths)
+
+    def search(self, loglikes, lengths):
+        num_batch = loglikes.shape[0]
+        with torch.no_grad():
+            loglikes = torch.log_softmax(loglikes.float().cpu() * self.acoustic_scale, dim=-1)
+            if self.beam_size <= 1:
+                return self.greedy(loglikes, lengths)
+            results = [self.prefix_beam_search(loglikes[i, :lengths[i]].numpy())
+                       for i in range(num_batch)]
+        return self._ragged(results)
+
+    def greedy(self, loglikes, lengths):
+        """
+        collapses the repeats and removes the blanks of the frame-wise argmax of the whole batch at once
+        """
+        num_batch, num_frame, _ = loglikes.shape
+        best = loglikes.argmax(dim=-1)
+        valid = torch.arange(num_frame).unsqueeze(0) < lengths.unsqueeze(1)
+        prev = torch.cat([torch.full((num_batch, 1), -1, dtype=best.dtype), best[:, :-1]], dim=1)
+        emit = (best != prev) & (best != self.blank) & valid
+        # the masked selections are row-major, so they are already the ragged values
+        offsets = lambda counts: torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(dim=0)]).int()
+        costs = -(loglikes.max(dim=-1)[0] * valid.float()).sum(dim=1)
+        failed = lengths == 0
+        costs[failed] = float("inf")
+        return DecoderOutput(words=(best[emit] + 1).int(), word_offsets=offsets(emit.sum(dim=1)),
+                             alignments=(best[valid] + 1).int(), alignment_offsets=offsets(lengths),
+                             costs=costs, partial=torch.zeros(num_batch, dtype=torch.int),
+                             failed=failed.int())
+
+    def _lm_score(self, state, column):
+        if self.lm is None:
+            return 0., None
+        return self.lm.score(state, self.symbols.lookup([column + 1])[0])
+
+    def prefix_beam_search(self, loglikes):
+        """
+        prefix beam search over the T x C log posteriors of an utterance,
+        returns the best sequence of the columns, its frame alignment and its score
+        """
+        T = len(loglikes)
+        if T == 0:
+            return [], np.zeros(0, dtype=np.int64), NEG_INF
+        root = ()
+        # prefix -> [log p ending in blank, log p ending in non-blank]
+        beams = {root: [0., NEG_INF]}
+        # prefix -> (accumulated lm score, lm state)
+        lms = {root: (0., self.lm.initial_state() if self.lm is not None else None)}
+        k = min(self.token_beam, loglikes.shape[1])
+
+        for t in range(T):
+            frame = loglikes[t]
+            cands = np.argpartition(frame, -k)[-k:]
+            cands = cands[cands != self.blank]
+            prefixes = list(beams)
+            pb = np.array([beams[x][0] for x in prefixes])
+            pnb = np.array([beams[x][1] for x in prefixes])
+            ptot = np.logaddexp(pb, pnb)
+            last = np.array([x[-1] if x else -1 for x in prefixes])
+
+            next_beams = collections.defaultdict(lambda: [NEG_INF, NEG_INF])
+            # staying on the prefix, by a blank or by repeating its last token
+            stay = np.where(last >= 0, pnb + frame[np.maximum(last, 0)], NEG_INF)
+            for i, prefix in enumerate(prefixes):
+                next_beams[prefix] = [ptot[i] + frame[self.blank], stay[i]]
+            # extending the prefixes with the candidate tokens, all at once;
+            # a repeat of the last token extends the prefix only after a blank
+            ext = np.where(last[:, None] == cands[None, :], pb[:, None], ptot[:, None]) + frame[cands][None, :]
+            for i, j in zip(*np.nonzero(ext > NEG_INF)):
+                prefix, c = prefixes[i], int(cands[j])
+                new = prefix + (c,)
+                if new not in lms:
+                    score, state = self._lm_score(lms[prefix][1], c)
+                    lms[new] = (lms[prefix][0] + score, state)
+                p = next_beams[new]
+                p[1] = np.logaddexp(p[1], ext[i, j])
+
+            beams = self._prune(next_beams, lms)
+            lms = {x: lms[x] for x in beams}
+
+        scores = {x: self._total(x, beams[x], lms, final=True) for x in beams}
+        best = max(scores, key=scores.get)
+        return list(best), ctc_align(loglikes, np.array(best, dtype=np.int64), self.blank), scores[best]
+
+    def _total(self, prefix, p, lms, final=False):
+        score = np.logaddexp(*p) + self.insertion_bonus * len(prefix)
+        if self.lm is not None:
+            lm_score = lms[prefix][0] + (self.lm.final(lms[prefix][1]) if final else 0.)
+            score += self.lm_weight * lm_score
+        return score
+
+    def _prune(self, beams, lms):
+        prefixes = list(beams)
+        scores = np.array([self._total(x, beams[x], lms) for x in prefixes])
+        order = np.argsort(-scores)[:self.beam_size]
+        order = order[scores[order] >= scores[order[0]] - self.beam]
+        return {prefixes[i]: beams[prefixes[i]] for i in order}
+
+    def _ragged(self, results):
+        words, word_offsets = ragged([np.asarray(x[0], dtype=np.int64) + 1 for x in results])
+        alignments, alignment_offsets = ragged([x[1] + 1 for x in results])
+        costs = np.array([-x[2] for x in results], dtype=np.float32)
+        failed = np.array([len(x[1]) == 0 for x in results], dtype=np.int32)
+        return DecoderOutput(words=torch.from_numpy(words), word_offsets=torch.from_numpy(word_offsets),
+                             alignments=torch.from_numpy(alignments),
+                             alignment_offsets=torch.from_numpy(alignment_offsets),
+                             costs=torch.from_numpy(costs), partial=torch.zeros(len(results), dtype=torch.int),
+                             failed=torch.from_numpy(failed))
+
+    def texts(self, output):
+        """
+        converts the decoded token ids of a DecoderOutput into the strings of the symbols
+        """
+        return output.texts(self.symbols)
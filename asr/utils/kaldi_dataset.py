@@ -0,0 +1,117 @@
+#!python
+from pathlib import Path
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+
+from .kaldi_io import RandomAccessTableReader, load_scp_index, read_ark_vec_int
+from .logger import logger
+
+
+class SplicedFrames(object):
+    """Context windows of a feature matrix, spliced lazily when a frame is indexed
+
+    The edge frames are replicated for the windows running over the boundaries, as Kaldi's splice-feats does.
+
+    Args:
+        feats (ndarray): feature matrix of num_rows x feat_dim
+        left_context (int): number of frames on the left of the center frame
+        right_context (int): number of frames on the right of the center frame
+        num_frames (int): number of frames to be exposed, num_rows if None
+        channels (int): if > 1, each row is taken as channels x bins, e.g. written by asr.extract,
+                        and the window is laid out as channels x bins x frames like FrameSplitter
+    """
+
+    def __init__(self, feats, left_context, right_context, num_frames=None, channels=1):
+        self.feats = feats
+        self.left_context = left_context
+        self.right_context = right_context
+        self.num_frames = len(feats) if num_frames is None else num_frames
+        self.channels = channels
+        self.offsets = np.arange(-left_context, right_context + 1)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, fidx):
+        idx = np.clip(self.offsets + int(fidx), 0, len(self.feats) - 1)
+        window = self.feats[idx]
+        if self.channels > 1:
+            window = window.reshape(len(idx), self.channels, -1).transpose(1, 2, 0)
+        window = np.ascontiguousarray(window, dtype=np.float32)
+        return torch.from_numpy(window).view(-1)
+
+
+class KaldiFeatureDataset(Dataset):
+    """Dataset of Kaldi-extracted features paired with per-frame alignments
+
+    The features are looked up from the memory-mapped arks of the feats.scp, and the context
+    windows are spliced only for the frames sampled, so this can be used with AudioDataLoader
+    and AudioBatchSampler without any audio decoding or STFT.
+
+    Args:
+        feats_scp (path): feats.scp file
+        ali_file (path): ark file of the per-frame alignments, e.g. the output of ali-to-pdf
+                         or ali-to-phones --per-frame; the targets are not loaded if None
+        left_context (int): number of frames on the left of each center frame
+        right_context (int): number of frames on the right of each center frame
+        transform (callable): applied to the feature matrix of an utterance before splicing
+        target_transform (callable): applied to the list of the frame targets of an utterance,
+                                     e.g. Int2OneHot; the targets are a LongTensor if None
+        channels (int): number of the channels in a feature row, see SplicedFrames
+        build_index (bool): stores the shapes of the features scanned into the sidecar index
+                            of the feats.scp, to be reused by the next loads (see load_scp_index)
+    """
+    entries = list()
+    entry_frames = list()
+
+    def __init__(self, feats_scp, ali_file=None, left_context=10, right_context=10,
+                 transform=None, target_transform=None, channels=1, build_index=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.feats_scp = Path(feats_scp).resolve()
+        self.ali_file = None if ali_file is None else Path(ali_file).resolve()
+        self.left_context = left_context
+        self.right_context = right_context
+        self.transform = transform
+        self.target_transform = target_transform
+        self.channels = channels
+        self.build_index = build_index
+        self.reader = RandomAccessTableReader(self.feats_scp)
+        self._load_entries()
+
+    def __getitem__(self, index):
+        uttid = self.entries[index]
+        feats = self.reader[uttid]
+        if self.transform is not None:
+            feats = self.transform(feats)
+        tensors = SplicedFrames(feats, self.left_context, self.right_context, self.entry_frames[index],
+                                self.channels)
+        if self.alignments is None:
+            return tensors, None
+        targets = self.alignments[uttid][:self.entry_frames[index]]
+        if self.target_transform is not None:
+            return tensors, self.target_transform(targets.tolist())
+        # the frame targets are indexed into 0-dim tensors, to be stacked by AudioCollateFn
+        return tensors, torch.from_numpy(targets.astype(np.int64))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _load_entries(self):
+        logger.info(f"loading features {self.feats_scp} ...")
+        feat_lens = {x[0]: x[3] for x in load_scp_index(self.feats_scp, build=self.build_index)}
+        if self.ali_file is None:
+            self.alignments = None
+            self.entries = list(self.reader)
+            self.entry_frames = [feat_lens[uttid] for uttid in self.entries]
+        else:
+            logger.info(f"loading alignments {self.ali_file} ...")
+            alis, uttids = read_ark_vec_int(self.ali_file)
+            self.alignments = dict(zip(uttids, alis))
+            self.entries = [uttid for uttid in self.reader if uttid in self.alignments]
+            # the lengths of the features and the alignments could differ by a few frames
+            self.entry_frames = [min(feat_lens[uttid], len(self.alignments[uttid]))
+                                 for uttid in self.entries]
+        logger.info(f"{len(self.entries)} entries, {sum(self.entry_frames)} frames are loaded.")
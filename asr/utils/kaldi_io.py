@@ -1,13 +1,107 @@
 import os
+import io
+import re
+import sys
+import signal
+import subprocess
+import mmap
 from pathlib import Path
 import numpy as np
 import gzip
 import bz2
 import struct
+import collections
+import itertools
+import threading
+import queue
 import functools
 import tempfile as tmp
 
 
+MATRIX_DTYPES = {"DM": np.dtype("<f8"), "FM": np.dtype("<f4")}
+MATRIX_FORMATS = {np.dtype("float64"): "DM", np.dtype("float32"): "FM"}
+
+# Kaldi's compressed matrix: CM (one byte per element with per-column percentile headers),
+# CM2 (two bytes per element) and CM3 (one byte per element), all decoded as float32
+COMPRESSED_FORMATS = ("CM", "CM2", "CM3")
+GLOBAL_HEADER = np.dtype([("min_value", "<f4"), ("range", "<f4"), ("num_rows", "<i4"), ("num_cols", "<i4")])
+PER_COL_HEADER = np.dtype([("p0", "<u2"), ("p25", "<u2"), ("p75", "<u2"), ("p100", "<u2")])
+
+# rxfilename with a byte offset, e.g. "foo.ark:1234"
+OFFSET_PATTERN = re.compile(r"^(.*):(\d+)$")
+
+
+class PipeFile(object):
+    """
+    File object on the stdout (read) or the stdin (write) of a shell command, as in the
+    rxfilename "cmd |" or the wxfilename "| cmd" of Kaldi. The command is waited for on close,
+    and an IOError is raised if it failed.
+    """
+
+    def __init__(self, cmd, mode='rb'):
+        self.cmd = cmd
+        self.reading = 'r' in mode
+        if self.reading:
+            self.proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            stream = self.proc.stdout
+        else:
+            self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+            stream = self.proc.stdin
+        self.stream = stream if 'b' in mode else io.TextIOWrapper(stream)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.stream.close()
+        except BrokenPipeError:
+            pass
+        ret = self.proc.wait()
+        self.proc = None
+        # a reader closed before the end of the output kills the command with SIGPIPE
+        if ret != 0 and not (self.reading and ret == -signal.SIGPIPE):
+            raise IOError(f"command \"{self.cmd}\" exited with status {ret}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StdFile(object):
+    """
+    File object on stdin or stdout, as in the rxfilename/wxfilename "-", which is left open on close.
+    """
+
+    def __init__(self, mode='rb'):
+        self.writing = 'r' not in mode
+        stream = sys.stdout if self.writing else sys.stdin
+        self.stream = stream.buffer if 'b' in mode else stream
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        if self.writing:
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def smart_open(filename, mode='rb', *args, **kwargs):
     '''
     Opens a file "smartly":
@@ -15,15 +109,84 @@ def smart_open(filename, mode='rb', *args, **kwargs):
         automatically;
       * If the file is to be read and does not exist, corresponding files with
         a ".gz" or ".bz2" extension will be attempted.
+      * Kaldi's rxfilenames "cmd |", "-" and "foo.ark:offset" are read from the output
+        of the command, stdin, and the offset of the file, respectively;
+      * Kaldi's wxfilenames "| cmd" and "-" are written to the input of the command and
+        stdout, respectively.
     '''
+    name = str(filename).strip()
+    if name == '-':
+        return StdFile(mode)
+    if 'r' in mode and name.endswith('|'):
+        return PipeFile(name[:-1], mode)
+    if 'r' not in mode and name.startswith('|'):
+        return PipeFile(name[1:], mode)
+
     readers = {'.gz': gzip.GzipFile, '.bz2': bz2.BZ2File}
+    offset = None
     if 'r' in mode and not Path(filename).exists():
+        m = OFFSET_PATTERN.match(name)
+        if m is not None and Path(m.group(1)).exists():
+            filename, offset = m.group(1), int(m.group(2))
         for ext in readers:
             if Path(str(filename)+ext).exists():
                 filename += ext
                 break
     ext = Path(filename).suffix
-    return readers.get(ext, open)(filename, mode, *args, **kwargs)
+    f = readers.get(ext, open)(filename, mode, *args, **kwargs)
+    if offset is not None:
+        f.seek(offset)
+    return f
+
+
+TableSpecifier = collections.namedtuple("TableSpecifier", ["type", "options", "filename", "scp_filename"])
+
+TABLE_OPTIONS = {"b", "t", "f", "nf", "p", "o", "no", "s", "ns", "cs", "ncs"}
+
+
+def _parse_specifier(specifier):
+    p = specifier.find(":")
+    if p < 0:
+        raise ValueError(f"invalid table specifier \"{specifier}\"")
+    types = [x.strip() for x in specifier[:p].split(",")]
+    options = set(x for x in types if x not in ("ark", "scp"))
+    types = [x for x in types if x in ("ark", "scp")]
+    if not types or options - TABLE_OPTIONS:
+        raise ValueError(f"invalid table specifier \"{specifier}\"")
+    return types, options, specifier[p+1:].strip()
+
+
+def parse_rspecifier(rspecifier):
+    """
+    Parses a Kaldi rspecifier such as "ark:foo.ark", "scp,s,cs:feats.scp" or
+    "ark:gunzip -c foo.ark.gz |" into a TableSpecifier of (type, options, filename, None).
+    """
+    types, options, filename = _parse_specifier(rspecifier)
+    if len(types) != 1:
+        raise ValueError(f"invalid rspecifier \"{rspecifier}\"")
+    if "t" in options:
+        raise ValueError(f"text archives are not supported: \"{rspecifier}\"")
+    return TableSpecifier(types[0], options, filename, None)
+
+
+def parse_wspecifier(wspecifier):
+    """
+    Parses a Kaldi wspecifier such as "ark:foo.ark", "ark,scp:foo.ark,foo.scp" or
+    "ark:| copy-feats ark:- ark:foo.ark" into a TableSpecifier of (type, options, filename, scp_filename).
+    """
+    types, options, filename = _parse_specifier(wspecifier)
+    if "t" in options:
+        raise ValueError(f"text archives are not supported: \"{wspecifier}\"")
+    if types == ["ark"]:
+        return TableSpecifier("ark", options, filename, None)
+    if sorted(types) == ["ark", "scp"]:
+        filenames = [x.strip() for x in filename.split(",", 1)]
+        if len(filenames) != 2:
+            raise ValueError(f"invalid wspecifier \"{wspecifier}\"")
+        if types[0] == "scp":
+            filenames.reverse()
+        return TableSpecifier("ark", options, filenames[0], filenames[1])
+    raise ValueError(f"only the archives can be written: \"{wspecifier}\"")
 
 
 def read_string(f):
@@ -77,22 +240,136 @@ def read_vec_int(f):
     return ans
 
 
+def read_into(f, data):
+    """
+    Reads the bytes of a preallocated contiguous array from f directly into its memory.
+    """
+    buf = memoryview(data.reshape(-1).view(np.uint8))
+    if not hasattr(f, "readinto"):
+        buf[:] = f.read(len(buf))
+        return data
+    pos = 0
+    while pos < len(buf):
+        n = f.readinto(buf[pos:])
+        if not n:
+            raise ValueError("EOF encountered while reading a matrix.")
+        pos += n
+    return data
+
+
+def compressed_nbytes(format, n_rows, n_cols):
+    if format == "CM":
+        return n_cols * (PER_COL_HEADER.itemsize + n_rows)
+    elif format == "CM2":
+        return n_rows * n_cols * 2
+    else:
+        return n_rows * n_cols
+
+
+def _uint16_to_float(header, value):
+    return header["min_value"] + header["range"] * np.float32(1.0 / 65535.0) * value.astype(np.float32)
+
+
+def decompress_matrix(format, header, buf, offset=0):
+    """
+    Decodes the data of a Kaldi compressed matrix following its global header.
+    """
+    n_rows, n_cols = int(header["num_rows"]), int(header["num_cols"])
+    if n_rows * n_cols == 0:
+        return np.zeros((n_rows, n_cols), dtype=np.float32)
+    min_value, range_ = np.float32(header["min_value"]), np.float32(header["range"])
+    if format == "CM2":
+        data = np.frombuffer(buf, dtype="<u2", count=n_rows * n_cols, offset=offset)
+        mat = min_value + range_ * np.float32(1.0 / 65535.0) * data.astype(np.float32)
+    elif format == "CM3":
+        data = np.frombuffer(buf, dtype=np.uint8, count=n_rows * n_cols, offset=offset)
+        mat = min_value + range_ * np.float32(1.0 / 255.0) * data.astype(np.float32)
+    else:
+        cols = np.frombuffer(buf, dtype=PER_COL_HEADER, count=n_cols, offset=offset)
+        p0, p25, p75, p100 = [_uint16_to_float(header, cols[k])[:, None] for k in PER_COL_HEADER.names]
+        # per-column lookup table of the 256 byte values
+        c = np.arange(256, dtype=np.float32)[None, :]
+        table = np.where(c <= 64, p0 + (p25 - p0) * c * np.float32(1 / 64.0),
+                         np.where(c <= 192, p25 + (p75 - p25) * (c - 64) * np.float32(1 / 128.0),
+                                  p75 + (p100 - p75) * (c - 192) * np.float32(1 / 63.0)))
+        data = np.frombuffer(buf, dtype=np.uint8, count=n_rows * n_cols,
+                             offset=offset + n_cols * PER_COL_HEADER.itemsize)
+        # column-major bytes
+        mat = np.take_along_axis(table.astype(np.float32), data.reshape(n_cols, n_rows).astype(np.intp), axis=1).T
+    return np.ascontiguousarray(mat.reshape(n_rows, n_cols), dtype=np.float32)
+
+
+def _float_to_uint(header, value, levels):
+    f = np.clip((value - header["min_value"]) / header["range"], 0.0, 1.0)
+    return (f * levels + 0.499).astype(np.int64)
+
+
+def compress_matrix(data, format="CM"):
+    """
+    Encodes a matrix into one of Kaldi's compressed matrix formats, as Kaldi's
+    CompressedMatrix does. Returns the global header and the bytes following it.
+    """
+    assert format in COMPRESSED_FORMATS, f"unknown compressed matrix format {format}"
+    data = np.asarray(data, dtype=np.float32)
+    n_rows, n_cols = data.shape
+    header = np.zeros(1, dtype=GLOBAL_HEADER)[0]
+    header["num_rows"], header["num_cols"] = n_rows, n_cols
+    if n_rows * n_cols == 0:
+        header["num_rows"] = header["num_cols"] = 0
+        return header, b""
+    min_value, max_value = data.min(), data.max()
+    assert np.isfinite(min_value) and np.isfinite(max_value), "Cannot compress a matrix with Nan's or Inf's"
+    if max_value == min_value:
+        max_value = min_value + (1.0 + abs(min_value))
+    header["min_value"] = min_value
+    header["range"] = np.float32(max_value) - np.float32(min_value)
+    if format == "CM2":
+        return header, _float_to_uint(header, data, 65535).astype("<u2").tobytes()
+    elif format == "CM3":
+        return header, _float_to_uint(header, data, 255).astype(np.uint8).tobytes()
+
+    # per-column percentiles, adjusted to be strictly increasing
+    s = np.sort(data, axis=0)
+    if n_rows >= 5:
+        q = n_rows // 4
+        idx = [0, q, 3 * q, n_rows - 1]
+    else:
+        idx = [0, 1, 2, 3]
+    p = [_float_to_uint(header, s[min(i, n_rows - 1)], 65535) for i in idx]
+    p[0] = np.minimum(p[0], 65532)
+    p[1] = np.minimum(np.maximum(p[1], p[0] + 1), 65533) if n_rows > 1 else p[0] + 1
+    p[2] = np.minimum(np.maximum(p[2], p[1] + 1), 65534) if n_rows > 2 else p[1] + 1
+    p[3] = np.maximum(p[3], p[2] + 1) if n_rows > 3 else p[2] + 1
+    cols = np.zeros(n_cols, dtype=PER_COL_HEADER)
+    for k, v in zip(PER_COL_HEADER.names, p):
+        cols[k] = v
+    p0, p25, p75, p100 = [_uint16_to_float(header, cols[k])[:, None] for k in PER_COL_HEADER.names]
+
+    # column-major bytes
+    v = data.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lo = np.clip(np.trunc((v - p0) / (p25 - p0) * 64 + 0.5), 0, 64)
+        mid = np.clip(64 + np.trunc((v - p25) / (p75 - p25) * 128 + 0.5), 64, 192)
+        hi = np.clip(192 + np.trunc((v - p75) / (p100 - p75) * 63 + 0.5), 192, 255)
+    chars = np.where(v < p25, lo, np.where(v < p75, mid, hi)).astype(np.uint8)
+    return header, cols.tobytes() + chars.tobytes()
+
+
 def read_matrix(f):
     header = f.read(2).decode('utf-8')
     if header != "\0B":
         raise ValueError("Binary mode header ('\0B') not found when attempting to read a matrix.")
     format = read_string(f)
+    if format in COMPRESSED_FORMATS:
+        header = np.frombuffer(f.read(GLOBAL_HEADER.itemsize), dtype=GLOBAL_HEADER)[0]
+        buf = f.read(compressed_nbytes(format, int(header["num_rows"]), int(header["num_cols"])))
+        return decompress_matrix(format, header, buf)
     n_rows = read_integer(f)
     n_cols = read_integer(f)
-    if format == "DM":
-        data = struct.unpack("<%dd" % (n_rows * n_cols), f.read(n_rows * n_cols * 8))
-        data = np.array(data, dtype="float64")
-    elif format == "FM":
-        data = struct.unpack("<%df" % (n_rows * n_cols), f.read(n_rows * n_cols * 4))
-        data = np.array(data, dtype="float32")
-    else:
-        raise ValueError("Unknown matrix format '%s' encountered while reading; currently supported formats are DM (float64) and FM (float32)." % format)
-    return data.reshape(n_rows, n_cols)
+    if format not in MATRIX_DTYPES:
+        raise ValueError("Unknown matrix format '%s' encountered while reading; currently supported formats are DM (float64), FM (float32) and CM, CM2, CM3 (compressed)." % format)
+    data = np.empty((n_rows, n_cols), dtype=MATRIX_DTYPES[format])
+    return read_into(f, data)
 
 
 def read_matrix_shape(f):
@@ -100,14 +377,17 @@ def read_matrix_shape(f):
     if header != "\0B":
         raise ValueError("Binary mode header ('\0B') not found when attempting to read a matrix.")
     format = read_string(f)
+    if format in COMPRESSED_FORMATS:
+        header = np.frombuffer(f.read(GLOBAL_HEADER.itemsize), dtype=GLOBAL_HEADER)[0]
+        n_rows, n_cols = int(header["num_rows"]), int(header["num_cols"])
+        f.seek(compressed_nbytes(format, n_rows, n_cols), os.SEEK_CUR)
+        return n_rows, n_cols
     n_rows = read_integer(f)
     n_cols = read_integer(f)
-    if format == "DM":
-        f.seek(n_rows * n_cols * 8, os.SEEK_CUR)
-    elif format == "FM":
-        f.seek(n_rows * n_cols * 4, os.SEEK_CUR)
+    if format in MATRIX_DTYPES:
+        f.seek(n_rows * n_cols * MATRIX_DTYPES[format].itemsize, os.SEEK_CUR)
     else:
-        raise ValueError("Unknown matrix format '%s' encountered while reading; currently supported formats are DM (float64) and FM (float32)." % format)
+        raise ValueError("Unknown matrix format '%s' encountered while reading; currently supported formats are DM (float64), FM (float32) and CM, CM2, CM3 (compressed)." % format)
     return n_rows, n_cols
 
 
@@ -120,41 +400,279 @@ def write_integer(f, a):
     f.write(chr(len(s)).encode('utf-8') + s)
 
 
-def write_matrix(f, data):
-    f.write('\0B'.encode('utf-8'))      # Binary data header
-    if str(data.dtype) == "float64":
-        write_string(f, "DM")
-        write_integer(f, data.shape[0])
-        write_integer(f, data.shape[1])
-        f.write(struct.pack("<%dd" % data.size, *data.ravel()))
-    elif str(data.dtype) == "float32":
-        write_string(f, "FM")
-        write_integer(f, data.shape[0])
-        write_integer(f, data.shape[1])
-        f.write(struct.pack("<%df" % data.size, *data.ravel()))
-    else:
+def write_matrix(f, data, compress=None):
+    """
+    If compress is either one of "CM", "CM2" or "CM3", the matrix is written compressed
+    in that format.
+    """
+    if compress is not None:
+        header, buf = compress_matrix(data, compress)
+        f.write('\0B'.encode('utf-8'))      # Binary data header
+        write_string(f, compress)
+        f.write(header.tobytes())
+        f.write(buf)
+        return
+    format = MATRIX_FORMATS.get(data.dtype.newbyteorder('='))
+    if format is None:
         raise ValueError("Unsupported matrix format '%s' for writing; currently supported formats are float64 and float32." % str(data.dtype))
+    f.write('\0B'.encode('utf-8'))      # Binary data header
+    write_string(f, format)
+    write_integer(f, data.shape[0])
+    write_integer(f, data.shape[1])
+    # no copy if the data is already contiguous and little-endian
+    data = np.ascontiguousarray(data, dtype=MATRIX_DTYPES[format])
+    f.write(memoryview(data.reshape(-1).view(np.uint8)))
 
 
-def read_ark(filename, limit=np.inf):
+class ArkBuffer(object):
     """
-    Reads the features in a Kaldi ark file.
-    Returns a list of feature matrices and a list of the utterance IDs.
+    Buffered parser of a Kaldi ark stream, with the same semantics as read_string,
+    read_integer, read_matrix and read_vec_int, but scanning the keys and headers out of
+    the whole file memory-mapped (for plain files) or out of large chunks read from the
+    stream (for compressed files and pipes) instead of reading them byte by byte.
+    If buf is given instead of f, it is parsed from pos and is not closed by close().
     """
-    features = []
-    uttids = []
-    with smart_open(filename, "rb") as f:
+
+    def __init__(self, f=None, chunk_size=1 << 22, buf=None, pos=0):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.mapped = False
+        self.owned = False
+        if buf is not None:
+            self.buf = buf
+            self.pos = pos
+            self.mapped = True
+        elif isinstance(f, io.BufferedReader):
+            try:
+                self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.pos = f.tell()
+                self.mapped = self.owned = True
+            except (ValueError, OSError, io.UnsupportedOperation):
+                pass  # empty file or not a regular file
+        if not self.mapped:
+            self.buf = b""
+            self.pos = 0
+
+    def close(self):
+        if self.owned:
+            self.buf.close()
+
+    def _fill(self, n):
+        # make at least n bytes available from self.pos, returns False on EOF
+        if len(self.buf) - self.pos >= n:
+            return True
+        if self.mapped:
+            return False
+        chunk = self.f.read(max(self.chunk_size, n - len(self.buf) + self.pos))
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return len(self.buf) >= n
+
+    def _find(self, sep):
         while True:
+            i = self.buf.find(sep, self.pos)
+            if i >= 0:
+                return i
+            if not self._fill(len(self.buf) - self.pos + 1):
+                return -1
+
+    def read_bytes(self, n):
+        if not self._fill(n):
+            raise ValueError("EOF encountered while reading %d bytes." % n)
+        b = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return b
+
+    def read_string(self):
+        i = self._find(b" ")
+        if i < 0:
+            raise ValueError("EOF encountered while reading a string.")
+        s = self.buf[self.pos:i]
+        self.pos = i + 1
+        return bytes(s).decode('utf-8')
+
+    def read_integer(self):
+        n = self.read_bytes(1)[0]
+        return int.from_bytes(self.read_bytes(n), byteorder='little', signed=False)
+
+    def read_array(self, dtype, count, copy=True):
+        dtype = np.dtype(dtype)
+        n = dtype.itemsize * count
+        if not self._fill(n):
+            raise ValueError("EOF encountered while reading an array.")
+        data = np.frombuffer(self.buf, dtype=dtype, count=count, offset=self.pos)
+        self.pos += n
+        return data.copy() if copy else data
+
+    def read_vec_int(self):
+        header = self.read_bytes(2)
+        if header == b"\0B":  # binary flag
+            assert self.read_bytes(1) == b'\4'  # int-size
+            vec_size = self.read_array(np.int32, 1)[0]  # vector dim
+            # Elements from int32 vector are sored in tuples: (sizeof(int32), value),
+            dt = [('size', np.int8), ('value', np.int32)]
+            vec = self.read_array(dt, int(vec_size))
+            assert vec_size == 0 or vec[0]['size'] == 4  # int32 size,
+            ans = vec[:]['value']  # values are in 2nd column,
+        else:  # ascii,
+            i = self._find(b"\n")
+            i = len(self.buf) if i < 0 else i + 1
+            arr = (bytes(header) + bytes(self.buf[self.pos:i])).decode().strip().split()
+            self.pos = i
             try:
-                uttid = read_string(f)
+                arr.remove('[')
+                arr.remove(']')  # optionally
             except ValueError:
+                pass
+            ans = np.array(arr, dtype=int)
+        return ans
+
+    def read_matrix_header(self):
+        """
+        Returns the format, the shape and, for the compressed formats, the global header
+        """
+        header = self.read_bytes(2)
+        if header != b"\0B":
+            raise ValueError("Binary mode header ('\0B') not found when attempting to read a matrix.")
+        format = self.read_string()
+        if format in COMPRESSED_FORMATS:
+            header = self.read_array(GLOBAL_HEADER, 1)[0]
+            return format, int(header["num_rows"]), int(header["num_cols"]), header
+        n_rows = self.read_integer()
+        n_cols = self.read_integer()
+        if format not in MATRIX_DTYPES:
+            raise ValueError("Unknown matrix format '%s' encountered while reading; currently supported formats are DM (float64), FM (float32) and CM, CM2, CM3 (compressed)." % format)
+        return format, n_rows, n_cols, None
+
+    def read_matrix(self, copy=True):
+        """
+        If copy is False, an uncompressed matrix is a read-only view on the buffer, without any copy
+        """
+        format, n_rows, n_cols, header = self.read_matrix_header()
+        if format in COMPRESSED_FORMATS:
+            n = compressed_nbytes(format, n_rows, n_cols)
+            if not self._fill(n):
+                raise ValueError("EOF encountered while reading a compressed matrix.")
+            data = decompress_matrix(format, header, self.buf, self.pos)
+            self.pos += n
+            return data
+        return self.read_array(MATRIX_DTYPES[format], n_rows * n_cols, copy).reshape(n_rows, n_cols)
+
+
+def prefetch(iterable, size):
+    """
+    Iterates over iterable on a background thread, reading ahead up to size items.
+    """
+    q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        it = iter(iterable)
+        try:
+            for item in it:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+        finally:
+            # the source, e.g. a pipe behind _iter_ark, is closed on this thread which runs it
+            if hasattr(it, "close"):
+                it.close()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, e = q.get()
+            if e is not None:
+                raise e
+            if item is end:
                 break
-            feature = read_matrix(f)
-            features.append(feature)
-            uttids.append(uttid)
-            if len(features) == limit:
-                break
-    return features, uttids
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _iter_ark(filename, read_fn):
+    with smart_open(filename, "rb") as f:
+        ark = ArkBuffer(f)
+        try:
+            while True:
+                try:
+                    uttid = ark.read_string()
+                except ValueError:
+                    break
+                yield uttid, read_fn(ark)
+        finally:
+            ark.close()
+
+
+def iter_ark(filename, prefetch_size=0):
+    """
+    Iterates over the features in a Kaldi ark file, yielding (uttid, matrix) lazily
+    so that an archive of any size is read at constant memory.
+    If prefetch_size > 0, up to that many matrices are read ahead on a background thread.
+    """
+    it = _iter_ark(filename, lambda ark: ark.read_matrix())
+    return prefetch(it, prefetch_size) if prefetch_size > 0 else it
+
+
+def iter_ark_vec_int(filename, prefetch_size=0):
+    """
+    Iterates over the int vectors (e.g. alignments) in a Kaldi ark file, yielding (uttid, vector) lazily.
+    """
+    it = _iter_ark(filename, lambda ark: ark.read_vec_int())
+    return prefetch(it, prefetch_size) if prefetch_size > 0 else it
+
+
+def iter_scp(filename, prefetch_size=0):
+    """
+    Iterates over the features in a Kaldi script file, yielding (uttid, matrix) lazily.
+    If prefetch_size > 0, up to that many matrices are read ahead on a background thread.
+    """
+    def it():
+        with RandomAccessTableReader(filename, copy=True) as reader:
+            for uttid in reader:
+                yield uttid, reader[uttid]
+
+    return prefetch(it(), prefetch_size) if prefetch_size > 0 else it()
+
+
+def _read_table(it, limit):
+    values, uttids = [], []
+    for uttid, value in itertools.islice(it, None if limit == np.inf else int(limit)):
+        values.append(value)
+        uttids.append(uttid)
+    return values, uttids
+
+
+def read_ark(filename, limit=np.inf):
+    """
+    Reads the features in a Kaldi ark file.
+    Returns a list of feature matrices and a list of the utterance IDs.
+    """
+    return _read_table(iter_ark(filename), limit)
+
+
+def read_ark_vec_int(filename, limit=np.inf):
+    """
+    Reads the int vectors (e.g. alignments) in a Kaldi ark file.
+    Returns a list of int vectors and a list of the utterance IDs.
+    """
+    return _read_table(iter_ark_vec_int(filename), limit)
 
 
 def read_matrix_by_offset(arkfile, offset):
@@ -164,64 +682,327 @@ def read_matrix_by_offset(arkfile, offset):
     return feature
 
 
+def parse_scp_line(line):
+    uttid, pointer = line.strip().split(" ", 1)
+    pointer = pointer.strip()
+    m = OFFSET_PATTERN.match(pointer)
+    if m is None:
+        # a whole file or the output of a command, e.g. "gunzip -c foo.ark.gz |"
+        return uttid, pointer, 0
+    return uttid, m.group(1), int(m.group(2))
+
+
+class ArkHandlePool(object):
+    """
+    LRU pool of the ark files opened for random access, each of which is memory-mapped
+    only once and shared by all the lookups pointing into it. At most max_open files are
+    kept mapped, so the number of file descriptors is bounded. Compressed arks cannot be
+    mapped, so they are decompressed once into memory instead.
+    An evicted map still exported to the views returned by the readers (copy=False) cannot be
+    closed yet; it is kept pending, and closed by the following lookups once the views are gone.
+    """
+
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self.handles = collections.OrderedDict()
+        self.pending = list()
+
+    def get(self, arkfile):
+        if arkfile in self.handles:
+            self.handles.move_to_end(arkfile)
+            return self.handles[arkfile]
+        self._close_pending()
+        with smart_open(arkfile, "rb") as f:
+            if isinstance(f, io.BufferedReader) and os.fstat(f.fileno()).st_size > 0:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buf = f.read()
+        self.handles[arkfile] = buf
+        while len(self.handles) > self.max_open:
+            self._release(self.handles.popitem(last=False)[1])
+        return buf
+
+    def _release(self, buf):
+        if isinstance(buf, mmap.mmap):
+            try:
+                buf.close()
+            except BufferError:
+                self.pending.append(buf)  # views are still alive
+
+    def _close_pending(self):
+        pending, self.pending = self.pending, list()
+        for buf in pending:
+            self._release(buf)
+
+    def close(self):
+        while self.handles:
+            self._release(self.handles.popitem()[1])
+        self._close_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RandomAccessTableReader(object):
+    """
+    Random-access reader of the matrices in a Kaldi script file, looked up by uttid.
+    The matrices are returned as zero-copy read-only views on the memory-mapped arks,
+    unless copy is True.
+
+    Args:
+        filename (path): scp file
+        pool (ArkHandlePool): pool of the opened arks, possibly shared between readers
+        copy (bool): return writable copies instead of views
+    """
+
+    def __init__(self, filename, pool=None, copy=False):
+        self.pool = ArkHandlePool() if pool is None else pool
+        self.copy = copy
+        self.pointers = collections.OrderedDict()
+        with smart_open(filename, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                uttid, arkfile, offset = parse_scp_line(line)
+                self.pointers[uttid] = (arkfile, offset)
+
+    def _ark(self, uttid):
+        arkfile, offset = self.pointers[uttid]
+        return ArkBuffer(buf=self.pool.get(arkfile), pos=offset)
+
+    def __getitem__(self, uttid):
+        return self._ark(uttid).read_matrix(copy=self.copy)
+
+    def __contains__(self, uttid):
+        return uttid in self.pointers
+
+    def __len__(self):
+        return len(self.pointers)
+
+    def __iter__(self):
+        return iter(self.pointers)
+
+    def shape(self, uttid):
+        format, n_rows, n_cols, header = self._ark(uttid).read_matrix_header()
+        return n_rows, n_cols
+
+    def info(self, uttid):
+        arkfile, offset = self.pointers[uttid]
+        feat_len, feat_dim = self.shape(uttid)
+        return uttid, arkfile, offset, feat_len, feat_dim
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def read_scp(filename, limit=np.inf):
     """
     Reads the features in a Kaldi script file.
     Returns a list of feature matrices and a list of the utterance IDs.
     """
-    features = []
-    uttids = []
-    with smart_open(filename, "r") as f:
-        for line in f:
-            uttid, pointer = line.strip().split(" ", 1)
-            p = pointer.rfind(":")
-            arkfile, offset = pointer[:p], int(pointer[p+1:])
-            with smart_open(arkfile, "rb") as g:
-                g.seek(offset)
-                feature = read_matrix(g)
-            features.append(feature)
-            uttids.append(uttid)
-            if len(features) == limit:
-                break
-    return features, uttids
+    return _read_table(iter_scp(filename), limit)
 
 
-def read_scp_info(filename, limit=np.inf):
+def _permissive(it):
+    # stops quietly at the first entry failed to be read, as the "p" option of Kaldi
+    try:
+        yield from it
+    except (ValueError, IOError, EOFError):
+        return
+
+
+def iter_table(rspecifier, prefetch_size=0):
+    """
+    Iterates over the matrices of a Kaldi rspecifier, e.g. "ark:foo.ark", "scp:feats.scp",
+    "ark:gunzip -c foo.ark.gz |" or "ark:-", yielding (uttid, matrix) lazily.
+    The archives read from pipes are streamed without any temporary file.
+    """
+    spec = parse_rspecifier(rspecifier)
+    if spec.type == "ark":
+        it = _iter_ark(spec.filename, lambda ark: ark.read_matrix())
+    else:
+        it = iter_scp(spec.filename)
+    if "p" in spec.options:
+        it = _permissive(it)
+    return prefetch(it, prefetch_size) if prefetch_size > 0 else it
+
+
+def read_table(rspecifier, limit=np.inf):
+    """
+    Reads the matrices of a Kaldi rspecifier.
+    Returns a list of feature matrices and a list of the utterance IDs.
+    """
+    return _read_table(iter_table(rspecifier), limit)
+
+
+class TableWriter(object):
+    """
+    Writer of the matrices to a Kaldi wspecifier, e.g. "ark:foo.ark", "ark,scp:foo.ark,foo.scp",
+    "ark:| gzip -c > foo.ark.gz" or "ark:-". The scp cannot be written along with an archive
+    going to a pipe or stdout, since there is no offset to point to.
+
+    Args:
+        wspecifier (str): Kaldi wspecifier
+        compress (str): compressed matrix format, one of COMPRESSED_FORMATS, or None
+    """
+
+    def __init__(self, wspecifier, compress=None):
+        self.spec = parse_wspecifier(wspecifier)
+        self.compress = compress
+        self.flush = "f" in self.spec.options
+        piped = self.spec.filename == "-" or self.spec.filename.startswith("|")
+        if self.spec.scp_filename is not None and piped:
+            raise ValueError(f"scp cannot point into a piped archive: \"{wspecifier}\"")
+        self.ark = smart_open(self.spec.filename, "wb")
+        self.scp = None
+        if self.spec.scp_filename is not None:
+            self.scp = smart_open(self.spec.scp_filename, "w")
+
+    def write(self, uttid, matrix):
+        write_string(self.ark, uttid)
+        if self.scp is not None:
+            self.scp.write("%s %s:%d\n" % (uttid, self.spec.filename, self.ark.tell()))
+        write_matrix(self.ark, matrix, self.compress)
+        if self.flush:
+            self.ark.flush()
+
+    def close(self):
+        if self.scp is not None:
+            self.scp.close()
+            self.scp = None
+        if self.ark is not None:
+            self.ark.close()
+            self.ark = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_table(wspecifier, features, uttids, compress=None):
+    """
+    Takes a list of feature matrices and a list of utterance IDs,
+      and writes them to a Kaldi wspecifier, compressed if compress is given.
+    """
+    with TableWriter(wspecifier, compress) as writer:
+        for feature, uttid in zip(features, uttids):
+            writer.write(uttid, feature)
+
+
+def _index_ark(args):
+    arkfile, pointers = args
     res = []
-    with smart_open(filename, "r") as f:
-        for line in f:
-            uttid, pointer = line.strip().split()
-            p = pointer.rfind(":")
-            arkfile, offset = pointer[:p], int(pointer[p+1:])
-            with smart_open(arkfile, "rb") as g:
-                g.seek(offset)
-                feat_len, feat_dim = read_matrix_shape(g)
-            res.append((uttid, arkfile, offset, feat_len, feat_dim))
-            if len(res) == limit:
-                break
+    with ArkHandlePool(max_open=1) as pool:
+        buf = pool.get(arkfile)
+        for uttid, offset in pointers:
+            format, n_rows, n_cols, _ = ArkBuffer(buf=buf, pos=offset).read_matrix_header()
+            res.append((uttid, arkfile, offset, n_rows, n_cols, format))
     return res
 
 
-def read_scp_info_dic(filename, limit=np.inf):
-    res = {}
+def scp_index_file(filename):
+    return Path(str(filename) + ".idx")
+
+
+def _is_index_valid(filename, index_file, arkfiles):
+    if not index_file.exists():
+        return False
+    mtime = index_file.stat().st_mtime
+    return all(Path(x).exists() and Path(x).stat().st_mtime <= mtime for x in [filename, *arkfiles])
+
+
+def scan_scp_index(filename, num_workers=1, limit=np.inf):
+    """
+    Parses the matrix header of every entry in a Kaldi script file, with the arks processed
+    in parallel if num_workers > 1, and returns (uttid, ark, offset, rows, cols, format)
+    of the first limit entries, without writing anything.
+    """
+    from multiprocessing import Pool
+
+    groups = collections.OrderedDict()
+    order = []
     with smart_open(filename, "r") as f:
         for line in f:
-            uttid, pointer = line.strip().split()
-            p = pointer.rfind(":")
-            arkfile, offset = pointer[:p], int(pointer[p+1:])
-            with smart_open(arkfile, "rb") as g:
-                g.seek(offset)
-                feat_len, feat_dim = read_matrix_shape(g)
-            res[uttid] = ((uttid, arkfile, offset, feat_len, feat_dim))
-            if len(res) == limit:
+            if not line.strip():
+                continue
+            if len(order) >= limit:
                 break
-    return res
+            uttid, arkfile, offset = parse_scp_line(line)
+            groups.setdefault(arkfile, []).append((uttid, offset))
+            order.append(uttid)
+    if num_workers > 1 and len(groups) > 1:
+        with Pool(min(num_workers, len(groups))) as pool:
+            results = pool.map(_index_ark, groups.items())
+    else:
+        results = [_index_ark(x) for x in groups.items()]
+    entries = {x[0]: x for res in results for x in res}
+    return [entries[uttid] for uttid in order]
+
+
+def build_scp_index(filename, num_workers=8):
+    """
+    Scans the entries of a Kaldi script file by scan_scp_index, and stores them in the sidecar
+    index file <filename>.idx, unless its dir is not writable. Returns the entries.
+    """
+    entries = scan_scp_index(filename, num_workers)
+    index_file = scp_index_file(filename)
+    tmp_file = Path(str(index_file) + ".tmp")
+    try:
+        with open(tmp_file, "w") as f:
+            for entry in entries:
+                f.write("%s\t%s\t%d\t%d\t%d\t%s\n" % entry)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        pass  # not writable, the index will be scanned again next time
+    return entries
+
+
+def load_scp_index(filename, num_workers=1, build=False):
+    """
+    Loads the entries (uttid, ark, offset, rows, cols, format) of a Kaldi script file from
+    its sidecar index, if it exists and is newer than the scp and all of its arks. Otherwise,
+    the entries are scanned in memory, and stored into a new sidecar index only if build is True
+    and the dir of the scp is writable.
+    """
+    index_file = scp_index_file(filename)
+    if index_file.exists():
+        with open(index_file, "r") as f:
+            entries = [x.rstrip("\n").split("\t") for x in f]
+        entries = [(u, a, int(o), int(r), int(c), fmt) for u, a, o, r, c, fmt in entries]
+        if _is_index_valid(filename, index_file, set(x[1] for x in entries)):
+            return entries
+    if build and os.access(index_file.parent, os.W_OK):
+        return build_scp_index(filename, num_workers)
+    return scan_scp_index(filename, num_workers)
+
+
+def read_scp_info(filename, limit=np.inf):
+    index_file = scp_index_file(filename)
+    entries = load_scp_index(filename) if index_file.exists() else scan_scp_index(filename, limit=limit)
+    if limit != np.inf:
+        entries = entries[:int(limit)]
+    return [x[:5] for x in entries]
+
+
+def read_scp_info_dic(filename, limit=np.inf):
+    return {x[0]: x for x in read_scp_info(filename, limit)}
 
 
-def write_ark(filename, features, uttids):
+def write_ark(filename, features, uttids, compress=None):
     """
     Takes a list of feature matrices and a list of utterance IDs,
-      and writes them to a Kaldi ark file.
+      and writes them to a Kaldi ark file, compressed if compress is given.
     Returns a list of strings in the format "filename:offset",
       which can be used to write a Kaldi script file.
     """
@@ -231,7 +1012,7 @@ def write_ark(filename, features, uttids):
         for feature, uttid in zip(features, uttids):
             write_string(f, uttid)
             pointers.append("%s:%d" % (filename, f.tell()))
-            write_matrix(f, feature)
+            write_matrix(f, feature, compress)
     return pointers
 
 
@@ -245,6 +1026,125 @@ def write_scp(filename, uttids, pointers):
             f.write("%s %s\n" % (uttid, pointer))
 
 
+class ArkShardWriter(object):
+    """
+    Writer of one shard of a sharded Kaldi table, i.e. an ark and its scp. Both are written
+    to temporary files first and renamed into place on commit, the ark before the scp, so that
+    an existing scp always points into a complete ark, even if the writer process gets killed.
+    Used as a context manager, it commits on success and aborts on an exception.
+
+    Args:
+        ark_file (path): ark file of the shard
+        scp_file (path): scp file of the shard
+        compress (str): compressed matrix format, one of COMPRESSED_FORMATS, or None
+    """
+
+    def __init__(self, ark_file, scp_file, compress=None):
+        self.ark_file = Path(ark_file).resolve()
+        self.scp_file = Path(scp_file).resolve()
+        self.compress = compress
+        self.tmp_ark_file = Path(str(self.ark_file) + ".tmp")
+        self.tmp_scp_file = Path(str(self.scp_file) + ".tmp")
+        self.ark = open(self.tmp_ark_file, "wb")
+        self.scp = open(self.tmp_scp_file, "w")
+        self.count = 0
+
+    def write(self, uttid, matrix):
+        write_string(self.ark, uttid)
+        # the pointers refer to the ark file name after the commit
+        self.scp.write("%s %s:%d\n" % (uttid, self.ark_file, self.ark.tell()))
+        write_matrix(self.ark, matrix, self.compress)
+        self.count += 1
+
+    def _close(self):
+        if self.ark is not None:
+            self.ark.close()
+            self.scp.close()
+            self.ark, self.scp = None, None
+
+    def commit(self):
+        self._close()
+        os.replace(self.tmp_ark_file, self.ark_file)
+        os.replace(self.tmp_scp_file, self.scp_file)
+
+    def abort(self):
+        self._close()
+        for tmp_file in (self.tmp_ark_file, self.tmp_scp_file):
+            if tmp_file.exists():
+                tmp_file.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+def shard_files(target_dir, name, shard_id):
+    """
+    Returns the ark and scp files of a shard, i.e. <target_dir>/<name>.<shard_id>.ark and .scp
+    """
+    prefix = str(Path(target_dir).resolve() / f"{name}.{shard_id:05d}")
+    return Path(prefix + ".ark"), Path(prefix + ".scp")
+
+
+def _write_shard(args):
+    func, jobs, ark_file, scp_file, compress = args
+    with ArkShardWriter(ark_file, scp_file, compress) as writer:
+        for job in jobs:
+            res = func(job)
+            if res is None:
+                continue
+            uttid, matrix = res
+            writer.write(uttid, matrix)
+    return writer.count
+
+
+def merge_scp(scp_files, filename):
+    """
+    Concatenates the scp files of the shards into a single scp, replaced atomically.
+    """
+    filename = Path(filename).resolve()
+    tmp_file = Path(str(filename) + ".tmp")
+    with open(tmp_file, "w") as f:
+        for scp_file in scp_files:
+            with open(scp_file, "r") as g:
+                f.write(g.read())
+    os.replace(tmp_file, filename)
+    return filename
+
+
+def write_ark_shards(func, jobs, target_dir, name, num_shards=8, num_workers=8, compress=None):
+    """
+    Applies func to every job on a pool of num_workers processes, and writes the (uttid, matrix)
+    returned into num_shards ark/scp pairs <target_dir>/<name>.<shard_id>.ark/scp, each written by
+    a single worker with ArkShardWriter and committed atomically when done. Jobs for which func
+    returns None are skipped. The scp of the shards are merged into <target_dir>/<name>.scp.
+    func should be picklable, i.e. a module-level function.
+    Returns the merged scp file and the number of the entries written.
+    """
+    from multiprocessing import Pool
+
+    target_dir = Path(target_dir).resolve()
+    target_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    jobs = list(jobs)
+    num_shards = max(1, min(num_shards, len(jobs)))
+    tasks = []
+    for shard_id in range(num_shards):
+        ark_file, scp_file = shard_files(target_dir, name, shard_id)
+        tasks.append((func, jobs[shard_id::num_shards], ark_file, scp_file, compress))
+    if num_workers > 1 and num_shards > 1:
+        with Pool(min(num_workers, num_shards)) as pool:
+            counts = pool.map(_write_shard, tasks, chunksize=1)
+    else:
+        counts = [_write_shard(x) for x in tasks]
+    scp_file = merge_scp([x[3] for x in tasks], target_dir / f"{name}.scp")
+    return scp_file, sum(counts)
+
+
 def tmp_write_ark(features, uttids):
     """
     Takes a list of feature matrices and a list of utterance IDs,
@@ -0,0 +1,100 @@
+#!python
+import os
+import json
+import hashlib
+from pathlib import Path
+
+
+def hash_bytes(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def hash_file(filename, chunk_size=1 << 22):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StageState(object):
+    """Content-addressed record of a data preparation stage
+
+    The inputs of a stage are split into units (e.g. a wav file, a line of text, an ali file),
+    each of which is recorded with the hash of its content, and produces a number of outputs
+    keyed by uttid, each recorded with the hash of the file written.
+    A unit is recomputed only if its input hash changed or any of its output files is missing.
+
+    Args:
+        state (dict): the state previously returned by StageState.state, or None
+    """
+
+    def __init__(self, state=None):
+        state = dict() if state is None else state
+        self.units = state.get("units", dict())
+        self.outputs = state.get("outputs", dict())
+        self.unit_outputs = dict()
+        for key, rec in self.outputs.items():
+            self.unit_outputs.setdefault(rec["unit"], list()).append(key)
+        self.seen = set()
+
+    @property
+    def state(self):
+        return {"units": self.units, "outputs": self.outputs}
+
+    def changed(self, unit, digest):
+        self.seen.add(unit)
+        if self.units.get(unit) != digest:
+            return True
+        return any(not Path(self.outputs[key]["file"]).exists()
+                   for key in self.unit_outputs.get(unit, list()))
+
+    def begin(self, unit, digest):
+        # forget the previous outputs of the unit, which is going to be recomputed
+        for key in self.unit_outputs.pop(unit, list()):
+            self.outputs.pop(key, None)
+        self.units[unit] = digest
+
+    def add(self, unit, key, **record):
+        record["unit"] = unit
+        self.outputs[key] = record
+        self.unit_outputs.setdefault(unit, list()).append(key)
+
+    def prune(self):
+        # drop the units not seen in the inputs anymore
+        for unit in set(self.units) - self.seen:
+            self.begin(unit, None)
+            del self.units[unit]
+
+    def digest(self):
+        return hash_bytes(*(f"{k}:{self.outputs[k].get('hash')}" for k in sorted(self.outputs)))
+
+
+class PrepState(object):
+    """Persistent states of the data preparation stages, stored as <state_dir>/<stage>.json
+
+    Args:
+        state_dir (path): dir to store the states
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = Path(state_dir).resolve()
+        self.state_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+
+    def load(self, stage):
+        state_file = self.state_dir / f"{stage}.json"
+        if not state_file.exists():
+            return None
+        with open(state_file, "r") as f:
+            return json.load(f)
+
+    def save(self, stage, state):
+        state_file = self.state_dir / f"{stage}.json"
+        tmp_file = state_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, state_file)
@@ -0,0 +1,221 @@
+#!python
+import os
+import random
+import wave
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+from torch.utils.data.sampler import Sampler
+
+from .audio import AudioDataset, match_length
+from .logger import logger
+
+
+"""
+Sharded sequential record format for training data
+
+Each shard file holds the records of a number of utterances back to back:
+
+    | pcm (int16, samples) | labels (int32, num_labels) | text (utf-8, text_bytes) | ...
+
+and a single csv index next to the shards describes where each record starts:
+
+    uttid,shard_file,offset,samples,num_labels,text_bytes,num_frames
+
+so that a whole shard can be read sequentially with one read call instead of
+opening three small files for each utterance.
+"""
+
+SHARD_SUFFIX = "shard"
+PCM_DTYPE = np.dtype("<i2")
+LABEL_DTYPE = np.dtype("<i4")
+
+
+def _read_pcm(wav_file, sample_rate):
+    with wave.open(str(wav_file), "rb") as wav:
+        assert wav.getsampwidth() == PCM_DTYPE.itemsize and wav.getnchannels() == 1, \
+            f"only 16-bit mono wav files can be packed: {wav_file}"
+        assert sample_rate is None or wav.getframerate() == sample_rate, \
+            f"sample rate mismatch in {wav_file}: {wav.getframerate()} != {sample_rate}"
+        return wav.readframes(wav.getnframes())
+
+
+def pack_shards(entries, target_dir, name, shard_size=1000, sample_rate=None):
+    """
+    Packs utterances into shard files and writes the index file
+
+    Args:
+        entries (iterable): tuples of (uttid, wav_file, num_frames, phn_file, txt_file),
+                            phn_file and txt_file can be None
+        target_dir (path): dir to store the shards and the index
+        name (str): prefix of the shard files, the index is stored as <name>.csv
+        shard_size (int): number of utterances per shard
+        sample_rate (int): if given, the wav files are checked to have this sample rate
+
+    Returns:
+        the path of the index file
+    """
+    target_dir = Path(target_dir).resolve()
+    target_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+    index_file = target_dir / f"{name}.csv"
+    index_tmp = index_file.with_suffix(".csv.tmp")
+
+    shard, offset, num_shards = None, 0, 0
+
+    def close_shard():
+        nonlocal shard
+        shard_file = Path(shard.name)
+        shard.close()
+        # only the complete shard becomes visible
+        os.replace(shard_file, shard_file.with_suffix(""))
+        shard = None
+
+    def abort_shard():
+        # the temp files of the failed shard and index are removed, not to be left behind
+        if shard is not None:
+            shard.close()
+            Path(shard.name).unlink()
+        if index_tmp.exists():
+            index_tmp.unlink()
+
+    logger.info(f"packing shards into {str(target_dir)} ...")
+    try:
+        with open(index_tmp, "w") as idx:
+            for i, (uttid, wav_file, num_frames, phn_file, txt_file) in enumerate(tqdm(entries)):
+                if i % shard_size == 0:
+                    if shard is not None:
+                        close_shard()
+                    shard_file = target_dir / f"{name}-{num_shards:05d}.{SHARD_SUFFIX}"
+                    shard = open(str(shard_file) + ".tmp", "wb")
+                    offset = 0
+                    num_shards += 1
+                pcm = _read_pcm(wav_file, sample_rate)
+                if phn_file is not None:
+                    labels = np.loadtxt(phn_file, dtype=LABEL_DTYPE, ndmin=1).astype(LABEL_DTYPE).tobytes()
+                else:
+                    labels = b""
+                if txt_file is not None:
+                    with open(txt_file, "r") as f:
+                        text = f.read().strip().encode("utf-8")
+                else:
+                    text = b""
+                shard.write(pcm)
+                shard.write(labels)
+                shard.write(text)
+                idx.write(f"{uttid},{shard_file.name},{offset},{len(pcm) // PCM_DTYPE.itemsize},"
+                          f"{len(labels) // LABEL_DTYPE.itemsize},{len(text)},{num_frames}\n")
+                offset += len(pcm) + len(labels) + len(text)
+            if shard is not None:
+                close_shard()
+    except BaseException:
+        abort_shard()
+        raise
+    os.replace(index_tmp, index_file)
+    logger.info(f"{num_shards} shards are written, indexed in {str(index_file)}")
+    return index_file
+
+
+class ShardSampler(Sampler):
+    """Samples the utterances shard by shard
+
+    The order of the shards is randomized every epoch (every time an iterator is made),
+    and the utterances are shuffled only within a shard, so that the dataset keeps
+    reading whole shards sequentially.
+
+    Args:
+        data_source (ShardedAudioDataset): dataset to sample from
+        shuffle (bool): if False, the shards and the utterances are in the stored order
+        seed (int): seed of the per-epoch shuffling, random if None
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+
+    def __iter__(self):
+        shards = list(self.data_source.shards.values())
+        if self.shuffle:
+            self.rng.shuffle(shards)
+        for indices in shards:
+            indices = list(indices)
+            if self.shuffle:
+                self.rng.shuffle(indices)
+            yield from indices
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class ShardedAudioDataset(AudioDataset):
+    """Audio dataset reading the records from shard files made by pack_shards
+
+    Args:
+        index_file (path): the index csv file written by pack_shards
+        unsup (bool): if True, the labels are not loaded
+        shard_buffer (int): number of whole shards kept in memory
+    """
+    entries = list()
+    entry_frames = list()
+
+    def __init__(self, index_file, unsup=False, shard_buffer=2, *args, **kwargs):
+        self.index_file = Path(index_file).resolve()
+        self.unsup = unsup
+        self.shard_buffer = shard_buffer
+        self.buffer = OrderedDict()
+        self._load_index()
+        super().__init__(*args, **kwargs)
+
+    def __getitem__(self, index):
+        uttid, shard_file, offset, samples, num_labels, text_bytes, num_frames = self.entries[index]
+        buf = self._load_shard(shard_file)
+        pcm = np.frombuffer(buf, dtype=PCM_DTYPE, count=samples, offset=offset)
+        if self.transform is not None:
+            tensors = self.transform(pcm)
+        if self.unsup:
+            return tensors, None
+        offset += samples * PCM_DTYPE.itemsize
+        targets = np.frombuffer(buf, dtype=LABEL_DTYPE, count=num_labels, offset=offset).tolist()
+        if self.target_transform is not None:
+            targets = self.target_transform(targets)
+        return match_length(tensors, targets)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_text(self, index):
+        uttid, shard_file, offset, samples, num_labels, text_bytes, num_frames = self.entries[index]
+        buf = self._load_shard(shard_file)
+        offset += samples * PCM_DTYPE.itemsize + num_labels * LABEL_DTYPE.itemsize
+        return bytes(buf[offset:offset + text_bytes]).decode("utf-8")
+
+    def make_sampler(self, shuffle):
+        return ShardSampler(self, shuffle=shuffle)
+
+    def _load_shard(self, shard_file):
+        if shard_file in self.buffer:
+            self.buffer.move_to_end(shard_file)
+            return self.buffer[shard_file]
+        with open(self.index_file.parent / shard_file, "rb") as f:
+            buf = f.read()
+        self.buffer[shard_file] = buf
+        while len(self.buffer) > self.shard_buffer:
+            self.buffer.popitem(last=False)
+        return buf
+
+    def _load_index(self):
+        logger.info(f"loading shard index {self.index_file} ...")
+        with open(self.index_file, "r") as f:
+            lines = f.readlines()
+        self.entries = list()
+        self.shards = OrderedDict()
+        for line in lines:
+            uttid, shard_file, *nums = line.strip().split(',')
+            self.shards.setdefault(shard_file, list()).append(len(self.entries))
+            self.entries.append((uttid, shard_file, *[int(x) for x in nums]))
+        self.entry_frames = [e[6] for e in self.entries]
+        logger.info(f"{len(self.entries)} entries in {len(self.shards)} shards, "
+                    f"{sum(self.entry_frames)} frames are loaded.")
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("scipy")
+pytest.importorskip("torchaudio")
+pytest.importorskip("sox")
+
+from asr.utils.ctc_decoder import CtcDecoder
+
+
+TOKENS = ["<eps>", "<blk>", "a", "b"]
+
+
+@pytest.fixture
+def token_file(tmp_path):
+    filename = tmp_path / "tokens.txt"
+    filename.write_text("".join(f"{sym} {idx}\n" for idx, sym in enumerate(TOKENS)))
+    return str(filename)
+
+
+def make_loglikes(columns, num_frame, num_token=len(TOKENS)):
+    # log posteriors of the frames dominated by the given columns, padded with blanks to num_frame
+    loglikes = np.full((len(columns), num_frame, num_token), np.log(0.01), dtype=np.float32)
+    for i, cols in enumerate(columns):
+        cols = list(cols) + [0] * (num_frame - len(cols))
+        loglikes[i, np.arange(num_frame), cols] = np.log(0.97)
+    return torch.from_numpy(loglikes)
+
+
+@pytest.mark.parametrize("beam_size", [1, 4])
+def test_blank_skip_expands_alignments(token_file, beam_size):
+    loglikes = make_loglikes([[0, 0, 0, 1, 1, 0, 0, 2, 0, 0], [0, 2, 0, 0, 0, 1]], 10)
+    lengths = torch.IntTensor([10, 6])
+
+    out = CtcDecoder(beam_size=beam_size, token_file=token_file)(loglikes, lengths)
+    skipped = CtcDecoder(beam_size=beam_size, token_file=token_file, blank_skip=0.9)(loglikes, lengths)
+
+    assert skipped.batch_size == 2
+    assert skipped.alignment_offsets.tolist() == [0, 10, 16]
+    assert skipped.words.tolist() == out.words.tolist() == [2, 3, 3, 2]
+    assert skipped.word_offsets.tolist() == out.word_offsets.tolist()
+    assert skipped.alignments.tolist() == out.alignments.tolist()
+
+
+def test_blank_skip_failed_utterance(token_file):
+    loglikes = make_loglikes([[0, 1, 0, 0], []], 4)
+    out = CtcDecoder(beam_size=4, token_file=token_file, blank_skip=0.9)(loglikes, torch.IntTensor([4, 0]))
+    assert out.failed.tolist() == [0, 1]
+    assert out.alignment_offsets.tolist() == [0, 4, 4]
+    assert out.words_of(0).tolist() == [2]
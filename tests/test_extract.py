@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("scipy")
+pytest.importorskip("torchaudio")
+pytest.importorskip("sox")
+
+from asr.extract import spect_to_matrix
+from asr.utils.audio import Spectrogram, FrameSplitter
+from asr.utils import params as p
+
+
+@pytest.fixture
+def spect():
+    samples = np.random.RandomState(0).randn(int(p.SAMPLE_RATE * 1.5)).astype(np.float32)
+    return Spectrogram(sample_rate=p.SAMPLE_RATE, window_shift=p.WINDOW_SHIFT, window_size=p.WINDOW_SIZE,
+                       window=p.WINDOW, nfft=p.NFFT)(samples)
+
+
+def test_frames_aligned_to_frame_splitter(spect):
+    frames = FrameSplitter(frame_margin=p.FRAME_MARGIN, unit_frames=p.HEIGHT)(spect)
+    feats = spect_to_matrix(spect)
+    # the targets are aligned to the frames of FrameSplitter, so are the rows of the features
+    assert len(feats) == len(frames) == spect.shape[2] - 2 * p.FRAME_MARGIN
+    half = (p.HEIGHT - 1) // 2
+    c, w, _ = spect.shape
+    for i in [0, len(frames) // 2, len(frames) - 1]:
+        center = frames[i].view(c, w, p.HEIGHT)[:, :, half].contiguous().view(-1).numpy()
+        np.testing.assert_allclose(feats[i], center)
+
+
+def test_no_margin(spect):
+    assert len(spect_to_matrix(spect, frame_margin=0)) == spect.shape[2]
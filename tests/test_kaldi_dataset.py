@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("scipy")
+pytest.importorskip("torchaudio")
+pytest.importorskip("sox")
+
+from asr.utils.kaldi_io import write_table
+from asr.utils.kaldi_dataset import KaldiFeatureDataset
+
+
+@pytest.fixture
+def feats_scp(tmp_path):
+    feats = [np.arange(5 * 3, dtype=np.float32).reshape(5, 3)]
+    write_table(f"ark,scp:{tmp_path / 'feats.ark'},{tmp_path / 'feats.scp'}", feats, ["utt1"])
+    return tmp_path / "feats.scp"
+
+
+@pytest.mark.parametrize("build_index", [False, True])
+def test_frames(feats_scp, build_index):
+    dataset = KaldiFeatureDataset(feats_scp, left_context=1, right_context=1, build_index=build_index)
+    assert len(dataset) == 1
+    frames, targets = dataset[0]
+    assert targets is None
+    assert len(frames) == 5
+    # the edge frame is replicated for the left context
+    assert frames[0].tolist() == [0., 1., 2., 0., 1., 2., 3., 4., 5.]
+    assert frames[4].shape == (9,)
+    assert feats_scp.with_name("feats.scp.idx").exists() == build_index
+
+
+def write_alignments(filename, alis):
+    # Kaldi's binary int32 vectors of (size, value) pairs
+    with open(filename, "wb") as f:
+        for uttid, ali in alis.items():
+            f.write(f"{uttid} ".encode("utf-8") + b"\0B\4" + np.int32(len(ali)).tobytes())
+            for x in ali:
+                f.write(b"\4" + np.int32(x).tobytes())
+
+
+def test_targets_collated(feats_scp, tmp_path):
+    from asr.utils.audio import AudioCollateFn
+
+    # the alignments could be a frame shorter than the features
+    write_alignments(tmp_path / "ali.ark", {"utt1": [3, 1, 4, 1]})
+    dataset = KaldiFeatureDataset(feats_scp, ali_file=tmp_path / "ali.ark", left_context=1, right_context=1)
+    assert dataset.entry_frames == [4]
+    tensors, targets = AudioCollateFn()(dataset, [(0, 0), (0, 2), (0, 3)])
+    assert tensors.shape == (3, 9)
+    assert targets.tolist() == [3, 4, 1]